@@ -0,0 +1,75 @@
+#Benchmark = Rows/sec and per batch latency of writing employees in 1000 row transactions, comparing the multi-VALUES insert with
+#            a commit per chunk, the staging upsert of insert_data and the prepared statements of the batch API (with and without synchronous commit)
+#Usage: python benchmarks/bench_batch_api.py [rows]
+#WARNING: it truncates the department, job and employee tables of the configured database
+import os
+import sys
+import time
+import statistics
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from api import db_URI, EmployeeSchema # noqa: E402
+import loader # noqa: E402
+from loader import upsert_frame, write_batch, rebuild_hire_summary, BATCH_SIZE # noqa: E402
+from bench_historical_load import reset_tables # noqa: E402
+from sqlalchemy import create_engine # noqa: E402
+from sqlalchemy.orm import Session # noqa: E402
+from sqlalchemy.dialects.postgresql import insert # noqa: E402
+
+
+#Employees with the same layout as the CSV files, every 50th one has a department that doesn't exist
+def make_rows(rows):
+   return [{"employee_id": i, "name": f"Employee {i}", "hired_at": f"2021-{i % 12 + 1:02d}-15T10:00:00Z",
+            "department_id": 999 if i % 50 == 0 else i % 12 + 1, "job_id": i % 183 + 1} for i in range(1, rows + 1)]
+
+
+def reset(engine):
+   reset_tables(engine)
+   connection = engine.raw_connection()
+   with connection.cursor() as cursor:
+      rebuild_hire_summary(cursor)
+   connection.commit()
+   connection.close()
+
+
+#Multi-VALUES insert compiled for every chunk and committed with the session, without foreign key checks or hire_summary updates
+def values_batch(engine, connection, batch):
+   with Session(engine) as session:
+      session.execute(insert(EmployeeSchema).values([dict(row, department_id=None) if row["department_id"] == 999 else row for row in batch]))
+      session.commit()
+
+
+def staging_batch(engine, connection, batch):
+   upsert_frame(connection, pd.DataFrame(batch, columns=loader.TABLE_COLUMNS["employee"]).astype(loader.READ_DTYPES["employee"]), "employee")
+
+
+def prepared_batch(engine, connection, batch):
+   write_batch(connection, [dict(row, row_number=number) for number, row in enumerate(batch, start=1)], "employee")
+
+
+def run(engine, write, rows):
+   reset(engine)
+   connection = engine.raw_connection()
+   latencies = []
+   start = time.perf_counter()
+   for i in range(0, len(rows), BATCH_SIZE):
+      batchStart = time.perf_counter()
+      write(engine, connection, rows[i:i+BATCH_SIZE])
+      latencies.append((time.perf_counter() - batchStart) * 1000)
+   seconds = time.perf_counter() - start
+   connection.close()
+   latencies.sort()
+   return len(rows) / seconds, statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+if __name__ == "__main__":
+   rows = make_rows(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
+   engine = create_engine(db_URI)
+   print(f"{'write path':>28} {'rows/s':>10} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+   for name, write, synchronous in [("multi-VALUES + commit", values_batch, "on"), ("staging upsert", staging_batch, "on"),
+                                    ("prepared batch", prepared_batch, "on"), ("prepared batch, async commit", prepared_batch, "off")]:
+      loader.BATCH_SYNCHRONOUS_COMMIT = synchronous
+      throughput, p50, p95 = run(engine, write, rows)
+      print(f"{name:>28} {throughput:>10,.0f} {p50:>9.2f} {p95:>9.2f}")
+   reset_tables(engine)
@@ -0,0 +1,43 @@
+#Benchmark = Rows/sec of staging an employee CSV with COPY split in 1, 2, 4 and 8 shards copied at the same time
+#Usage: python benchmarks/bench_copy_shards.py [rows] [shards...]
+#It creates and drops its own load tables, the data of the other tables isn't changed
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from api import db_URI # noqa: E402
+import loader # noqa: E402
+from jobs import Job, stage_table # noqa: E402
+from bench_historical_load import write_employees_csv # noqa: E402
+from sqlalchemy import create_engine # noqa: E402
+
+
+def drop_load_table(engine, name):
+   connection = engine.raw_connection()
+   with connection.cursor() as cursor:
+      cursor.execute(f"DROP TABLE IF EXISTS {name} CASCADE")
+   connection.commit()
+   connection.close()
+
+
+if __name__ == "__main__":
+   rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+   counts = [int(shards) for shards in sys.argv[2:]] or [1, 2, 4, 8]
+   engine = create_engine(db_URI, pool_size=max(counts) + 1)
+   loader.SHARD_MIN_BYTES = 1
+   print(f"CPU cores: {os.cpu_count()}")
+   print(f"{'shards':>7} {'seconds':>8} {'rows/s':>10}")
+   with tempfile.TemporaryDirectory() as folder:
+      path = os.path.join(folder, "hired_employees.csv")
+      write_employees_csv(path, rows)
+      for shards in counts:
+         loader.COPY_SHARDS = shards
+         job = Job("bench", engine)
+         start = time.perf_counter()
+         copied = stage_table(job, engine, path, "employee", "employee_load_bench")
+         seconds = time.perf_counter() - start
+         drop_load_table(engine, "employee_load_bench")
+         assert copied is not None and sum(copied) == rows, job.progress.errors
+         print(f"{shards:>7} {seconds:>8.2f} {rows / seconds:>10,.0f}")
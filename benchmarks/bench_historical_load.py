@@ -0,0 +1,66 @@
+#Benchmark = Compare rows/sec of the old pandas to_sql load against the COPY staging load used by upload_historical_data
+#Usage: python benchmarks/bench_historical_load.py [rows]
+#WARNING: it truncates the department, job and employee tables of the configured database
+import os
+import sys
+import time
+import random
+import tempfile
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from api import db_URI # noqa: E402
+from loader import bulk_load_table # noqa: E402
+from sqlalchemy import create_engine # noqa: E402
+
+
+#Write a synthetic hired_employees CSV with the same layout as data/Historical
+def write_employees_csv(path, rows, departments=12, jobs=183):
+   random.seed(42)
+   with open(path, "w", encoding="utf-8") as file:
+      for i in range(1, rows + 1):
+         department = random.randint(1, departments) if random.random() > 0.01 else ""
+         job = random.randint(1, jobs) if random.random() > 0.01 else ""
+         file.write(f"{i},Employee {i},2021-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}T10:00:00Z,{department},{job}\n")
+
+
+#Empty the tables and load the historical departments and jobs so the foreign keys are satisfied
+def reset_tables(engine):
+   connection = engine.raw_connection()
+   with connection.cursor() as cursor:
+      cursor.execute("TRUNCATE TABLE job,department,employee")
+      bulk_load_table(cursor, "data/Historical/departments.csv", "department")
+      bulk_load_table(cursor, "data/Historical/jobs.csv", "job")
+   connection.commit()
+   connection.close()
+
+
+def bench_to_sql(engine, path):
+   reset_tables(engine)
+   start = time.perf_counter()
+   employees = pd.read_csv(path, names=["employee_id", "name", "hired_at", "department_id", "job_id"])
+   employees.to_sql('employee', engine, if_exists='append', index=False)
+   return time.perf_counter() - start
+
+
+def bench_copy(engine, path):
+   reset_tables(engine)
+   start = time.perf_counter()
+   connection = engine.raw_connection()
+   with connection.cursor() as cursor:
+      bulk_load_table(cursor, path, "employee")
+   connection.commit()
+   connection.close()
+   return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+   rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+   engine = create_engine(db_URI)
+   with tempfile.TemporaryDirectory() as folder:
+      path = os.path.join(folder, "hired_employees.csv")
+      write_employees_csv(path, rows)
+      for name, bench in (("to_sql", bench_to_sql), ("copy", bench_copy)):
+         elapsed = bench(engine, path)
+         print(f"{name:>7}: {rows} rows in {elapsed:.2f}s - {rows / elapsed:,.0f} rows/sec")
+   reset_tables(engine)
@@ -0,0 +1,48 @@
+#Benchmark = Time until the response of the synchronous historical upload against the queued job, and the total time of the job
+#Usage: python benchmarks/bench_jobs.py [rows]
+#WARNING: it replaces the department, job and employee tables of the configured database
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from api import create_app # noqa: E402
+from bench_historical_load import write_employees_csv # noqa: E402
+
+
+def timed(function, *args):
+   start = time.perf_counter()
+   result = function(*args)
+   return result, time.perf_counter() - start
+
+
+def wait_for_job(client, url):
+   while True:
+      job = client.get(url).json
+      if job["status"] in ("succeeded", "failed"):
+         return job
+      time.sleep(0.01)
+
+
+if __name__ == "__main__":
+   rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+   root = os.getcwd()
+   with tempfile.TemporaryDirectory() as folder:
+      os.makedirs(os.path.join(folder, "data", "Historical"))
+      for name in ["departments.csv", "jobs.csv"]:
+         shutil.copy(os.path.join(root, "data", "Historical", name), os.path.join(folder, "data", "Historical", name))
+      write_employees_csv(os.path.join(folder, "data", "Historical", "hired_employees.csv"), rows)
+      os.chdir(folder)
+      client = create_app().test_client()
+
+      _, synchronous = timed(client.post, "/api/v1/upload_historical_data")
+      response, queued = timed(client.post, "/api/v1/jobs/upload_historical_data")
+      job, total = timed(wait_for_job, client, response.headers["Location"])
+      os.chdir(root)
+
+   print(f"{'employees':>10} {'sync response (s)':>18} {'job response (s)':>17} {'job total (s)':>14}")
+   print(f"{rows:>10,} {synchronous:>18.2f} {queued:>17.4f} {queued + total:>14.2f}")
+   for table, counters in job["tables"].items():
+      print(f"{table:>10} {counters['rows']:>10,} rows {counters['rows_per_second']:>12,.0f} rows/s")
@@ -0,0 +1,98 @@
+#Benchmark = Timings and plans of the SQL end-points on a synthetic employee table, comparing the old string datetime queries
+#            (on a varchar copy of the table) against the hire_summary queries used by the end-points
+#Usage: python benchmarks/bench_reports.py [rows]
+#WARNING: it truncates the department, job and employee tables of the configured database
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from api import db_URI, NUMBER_OF_EMPLOYEES_QUERY, HIRED_PER_DEPARTMENT_QUERY # noqa: E402
+from loader import rebuild_hire_summary # noqa: E402
+from bench_historical_load import reset_tables # noqa: E402
+from sqlalchemy import create_engine # noqa: E402
+
+OLD_NUMBER_OF_EMPLOYEES_QUERY = """SELECT de.department, jo.job, 
+                              SUM(CASE WHEN CAST(SUBSTRING(em.datetime,6,2) AS INT) BETWEEN 1 AND 3 THEN 1 ELSE 0 END) AS Q1,
+                              SUM(CASE WHEN CAST(SUBSTRING(em.datetime,6,2) AS INT) BETWEEN 4 AND 6 THEN 1 ELSE 0 END) AS Q2,
+                              SUM(CASE WHEN CAST(SUBSTRING(em.datetime,6,2) AS INT) BETWEEN 7 AND 9 THEN 1 ELSE 0 END) AS Q3,
+                              SUM(CASE WHEN CAST(SUBSTRING(em.datetime,6,2) AS INT) BETWEEN 10 AND 12 THEN 1 ELSE 0 END) AS Q4
+                        FROM employee_legacy AS em 
+                        LEFT JOIN department AS de ON em.department_id = de.department_id 
+                        LEFT JOIN job AS jo ON em.job_id = jo.job_id
+                        WHERE SUBSTRING(em.datetime,1,4) = '2021'
+                        GROUP BY de.department, jo.job
+                        ORDER BY de.department, jo.job"""
+
+OLD_HIRED_PER_DEPARTMENT_QUERY = """WITH average AS (SELECT AVG(hires) AS average_hires FROM (SELECT department_id, COUNT(*) AS hires 
+                                                                                   FROM employee_legacy 
+                                                                                   WHERE SUBSTRING(datetime,1,4) = '2021' AND department_id IS NOT NULL 
+                                                                                   GROUP BY department_id))
+                         SELECT em.department_id, de.department, COUNT(em.employee_id) AS hired
+                         FROM employee_legacy AS em
+                         LEFT JOIN department AS de ON em.department_id = de.department_id 
+                         GROUP BY em.department_id, de.department
+                         HAVING COUNT(em.employee_id) > (SELECT average_hires FROM average)
+                         ORDER BY hired DESC;"""
+
+
+#Fill the employee table with hires spread from 2012 to 2024, and a copy of it with the old varchar datetime column
+#Like on the real data, employee IDs are given in hiring order, so hire dates grow with the ID with a few days of noise
+def generate_employees(cursor, rows):
+   cursor.execute("""INSERT INTO employee (employee_id, name, hired_at, department_id, job_id)
+                     SELECT g, 'Employee ' || g,
+                            TIMESTAMPTZ '2012-01-01 00:00:00+00' + (g::FLOAT / %s) * INTERVAL '13 years' + random() * INTERVAL '3 days',
+                            CASE WHEN g %% 100 = 0 THEN NULL ELSE (g %% 12) + 1 END,
+                            CASE WHEN g %% 97 = 0 THEN NULL ELSE (g %% 183) + 1 END
+                     FROM generate_series(1, %s) AS g""", (rows, rows))
+   cursor.execute("DROP TABLE IF EXISTS employee_legacy")
+   cursor.execute("""CREATE TABLE employee_legacy AS
+                     SELECT employee_id, name, to_char(hired_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"')::VARCHAR(20) AS datetime, department_id, job_id
+                     FROM employee""")
+   rebuild_hire_summary(cursor)
+   cursor.execute("VACUUM ANALYZE employee")
+   cursor.execute("VACUUM ANALYZE employee_legacy")
+   cursor.execute("VACUUM ANALYZE hire_summary")
+
+
+#Best of several runs, in milliseconds, and the rows returned by the query
+def timed(cursor, query, params=None, runs=5):
+   best = None
+   for _ in range(runs):
+      start = time.perf_counter()
+      cursor.execute(query, params)
+      rows = cursor.fetchall()
+      elapsed = (time.perf_counter() - start) * 1000
+      best = elapsed if best is None else min(best, elapsed)
+   return best, rows
+
+
+#Plan actually executed by PostgreSQL for the query
+def explain(cursor, query, params=None):
+   cursor.execute("EXPLAIN (ANALYZE, COSTS OFF, TIMING OFF) " + query.as_string(cursor), params)
+   return "\n".join(row[0] for row in cursor.fetchall())
+
+
+if __name__ == "__main__":
+   rows = int(sys.argv[1]) if len(sys.argv) > 1 else 3000000
+   engine = create_engine(db_URI)
+   reset_tables(engine)
+   connection = engine.raw_connection()
+   #VACUUM can't run inside a transaction block
+   connection.driver_connection.autocommit = True
+   with connection.cursor() as cursor:
+      generate_employees(cursor, rows)
+      params = {"year": 2021}
+      for name, old, new in (("number-of-employees", OLD_NUMBER_OF_EMPLOYEES_QUERY, NUMBER_OF_EMPLOYEES_QUERY),
+                             ("hired-per-department", OLD_HIRED_PER_DEPARTMENT_QUERY, HIRED_PER_DEPARTMENT_QUERY)):
+         oldTime, oldRows = timed(cursor, old)
+         newTime, newRows = timed(cursor, new, params)
+         #Departments with the same number of hires can come in any order, so the rows are compared sorted
+         assert sorted(map(str, oldRows)) == sorted(map(str, newRows)), f"{name} results differ"
+         print(f"{name}: {rows:,} employees, before {oldTime:.1f} ms, after {newTime:.1f} ms")
+         print(explain(cursor, new, params))
+         print()
+      cursor.execute("DROP TABLE employee_legacy")
+   connection.driver_connection.autocommit = False
+   connection.close()
+   reset_tables(engine)
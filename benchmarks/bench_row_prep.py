@@ -0,0 +1,87 @@
+#Benchmark = Time, Python memory and garbage collections spent preparing 100,000 employee rows for the database, comparing the old
+#            to_dict("records") preparation, the float CSV encoding and the Int64 CSV encoding with pandas and with Arrow
+#Usage: python benchmarks/bench_row_prep.py [rows]
+#It doesn't connect to the database. Peak MB is the Python heap (numpy included) traced by tracemalloc
+import os
+import sys
+import io
+import gc
+import time
+import tracemalloc
+import warnings
+import random
+import tempfile
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from loader import frame_to_csv, READ_DTYPES, TABLE_COLUMNS # noqa: E402
+
+
+#Same layout as write_employees_csv of bench_historical_load, which can't be imported without a database
+def write_employees_csv(path, rows):
+   random.seed(42)
+   with open(path, "w", encoding="utf-8") as file:
+      for i in range(1, rows + 1):
+         department = random.randint(1, 12) if random.random() > 0.01 else ""
+         job = random.randint(1, 183) if random.random() > 0.01 else ""
+         file.write(f"{i},Employee {i},2021-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}T10:00:00Z,{department},{job}\n")
+
+
+#Preparation done by insert_data before the staging upsert: NaN rewritten as None, then a list of dicts sliced in lists of 1000
+def records(path):
+   frame = pd.read_csv(path, names=TABLE_COLUMNS["employee"])
+   for column in ["department_id", "job_id"]:
+      with warnings.catch_warnings():
+         warnings.simplefilter("ignore", FutureWarning)
+         frame.loc[frame[column].isna(), column] = ""
+      frame[column] = frame[column].replace('', None)
+   rows = frame.to_dict("records")
+   return [rows[i:i+1000] for i in range(0, len(rows), 1000)]
+
+
+#IDs read as float and written without decimals, as the staging upsert did before
+def float_csv(path):
+   frame = pd.read_csv(path, names=TABLE_COLUMNS["employee"], dtype={"department_id": float, "job_id": float})
+   buffer = io.StringIO()
+   frame.set_axis(frame.index + 1).to_csv(buffer, header=False, index=True, float_format="%.0f")
+   return buffer.getvalue()
+
+
+def int64_csv(path, arrow):
+   frame = pd.read_csv(path, names=TABLE_COLUMNS["employee"], dtype=READ_DTYPES["employee"])
+   if not arrow:
+      sys.modules["pyarrow"] = None
+   try:
+      return frame_to_csv(frame, "employee").read()
+   finally:
+      sys.modules["pyarrow"] = pa
+
+
+#Time is measured without tracemalloc, which slows down every allocation, and memory on a second run
+def measure(function, *args):
+   start = time.perf_counter()
+   function(*args)
+   seconds = time.perf_counter() - start
+   gc.collect()
+   collections = gc.get_stats()[0]["collections"]
+   tracemalloc.start()
+   function(*args)
+   peak = tracemalloc.get_traced_memory()[1]
+   tracemalloc.stop()
+   return seconds, peak, gc.get_stats()[0]["collections"] - collections
+
+
+if __name__ == "__main__":
+   rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+   per = 100000 / rows
+   with tempfile.TemporaryDirectory() as folder:
+      path = os.path.join(folder, "hired_employees.csv")
+      write_employees_csv(path, rows)
+      print(f"{'preparation':>24} {'ms/100k':>9} {'peak MB/100k':>13} {'gen0 GCs/100k':>14}")
+      for name, function, args in [("to_dict records", records, [path]), ("float to_csv", float_csv, [path]),
+                                   ("Int64 pandas to_csv", int64_csv, [path, False]), ("Int64 Arrow write_csv", int64_csv, [path, True])]:
+         seconds, peak, collections = min(measure(function, *args) for _ in range(3))
+         print(f"{name:>24} {seconds * 1000 * per:>9.1f} {peak / 1e6 * per:>13.1f} {collections * per:>14.0f}")
+      #Arrow buffers are allocated outside of the Python heap, so tracemalloc doesn't see them
+      print(f"Arrow memory pool peak: {pa.default_memory_pool().max_memory() / 1e6 * per:.1f} MB/100k")
@@ -0,0 +1,257 @@
+#Benchmark = Wall time, rows/sec, peak RSS and query count of upload_historical_data, insert_data and both report end-points
+#            on synthetic CSVs of any scale, compared against the stored baseline of the same scale (benchmarks/baseline.json)
+#Usage: python benchmarks/bench_suite.py [rows] [--new-rows N] [--data FOLDER] [--output FILE] [--save-baseline] [--tolerance 0.2]
+#Every end-point runs in a fresh process against a disposable database (gproject_bench_<pid>) created on the configured
+#PostgreSQL server and dropped at the end, the configured database isn't touched. It exits with 1 when a step regressed
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import multiprocessing
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+from dotenv import load_dotenv # type: ignore
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+#Rows generated and written to the CSV at a time, so the scale of the data doesn't change the memory of the generator
+GENERATOR_CHUNK = 1000000
+
+#Hire datetimes are spread between 2020 and 2022, so every report year has hires
+HIRED_FROM = int(pd.Timestamp("2020-01-01").timestamp())
+HIRED_TO = int(pd.Timestamp("2023-01-01").timestamp())
+
+#Ids of invalid foreign keys start here, no department or job of the data has them
+INVALID_ID = 100000
+
+#Requests of every step, in the order they run. The reports are asked as CSV so their rows can be counted
+STEPS = {
+   "upload_historical_data": ("POST", "/api/v1/upload_historical_data"),
+   "insert_data": ("POST", "/api/v1/insert_data"),
+   "number_of_employees": ("GET", "/api/v1/number-of-employees?format=csv&year=2021"),
+   "hired_per_department": ("GET", "/api/v1/hired-per-department?format=csv&year=2021"),
+}
+
+
+#Foreign keys between 1 and count. null_rate of them are missing and invalid_rate of them point to ids that don't exist
+def foreign_keys(rng, rows, count, null_rate, invalid_rate):
+   keys = rng.integers(1, count + 1, rows)
+   draw = rng.random(rows)
+   keys[draw < invalid_rate] = INVALID_ID + keys[draw < invalid_rate]
+   keys = pd.array(keys, dtype="Int64")
+   keys[draw >= 1 - null_rate] = pd.NA
+   return keys
+
+
+#Write departments.csv, jobs.csv and hired_employees.csv into folder with the layout of data/Historical
+#The employees get the ids first_id to first_id + employees - 1
+def write_dataset(folder, employees, departments, jobs, null_rate, invalid_rate, first_id=1, seed=42):
+   os.makedirs(folder, exist_ok=True)
+   rng = np.random.default_rng(seed)
+   for name, count in [("departments", departments), ("jobs", jobs)]:
+      ids = np.arange(1, count + 1)
+      pd.DataFrame({"id": ids, "name": [f"{name[:-1].title()} {i}" for i in ids]}).to_csv(os.path.join(folder, f"{name}.csv"), header=False, index=False)
+   with open(os.path.join(folder, "hired_employees.csv"), "w", encoding="utf-8", newline="") as file:
+      for start in range(first_id, first_id + employees, GENERATOR_CHUNK):
+         ids = np.arange(start, min(start + GENERATOR_CHUNK, first_id + employees))
+         pd.DataFrame({
+            "employee_id": ids,
+            "name": "Employee " + pd.Series(ids).astype(str),
+            "hired_at": pd.to_datetime(rng.integers(HIRED_FROM, HIRED_TO, len(ids)), unit="s"),
+            "department_id": foreign_keys(rng, len(ids), departments, null_rate, invalid_rate),
+            "job_id": foreign_keys(rng, len(ids), jobs, null_rate, invalid_rate),
+         }).to_csv(file, header=False, index=False, date_format="%Y-%m-%dT%H:%M:%SZ")
+
+
+#Historical data of rows employees, and new data for insert_data: 2 more departments, 5 more jobs and new_rows employees,
+#half of them updates of historical employees and half of them new ones
+def write_data(folder, rows, new_rows, departments, jobs, null_rate, invalid_rate):
+   historical = os.path.join(folder, "data", "Historical")
+   if not os.path.exists(os.path.join(historical, "hired_employees.csv")):
+      write_dataset(historical, rows, departments, jobs, null_rate, invalid_rate)
+   new = os.path.join(folder, "data", "New")
+   if not os.path.exists(os.path.join(new, "hired_employees.csv")):
+      write_dataset(new, new_rows, departments + 2, jobs + 5, null_rate, invalid_rate, first_id=rows - new_rows // 2 + 1, seed=43)
+
+
+def count_lines(path):
+   with open(path, "rb") as file:
+      return sum(block.count(b"\n") for block in iter(lambda: file.read(1 << 20), b""))
+
+
+#Peak resident memory of this process in MB. VmHWM starts again when a process is spawned, while ru_maxrss keeps the peak of the parent process
+def peak_rss():
+   with open("/proc/self/status") as file:
+      fields = dict(line.split(":", 1) for line in file if ":" in line)
+   return round(int(fields["VmHWM"].split()[0]) / 1024, 1)
+
+
+#Create a database for the run and drop it at the end, so the configured database is never touched
+@contextmanager
+def disposable_database():
+   load_dotenv()
+   name = f"gproject_bench_{os.getpid()}"
+   connection = psycopg2.connect(dbname="postgres", user=os.getenv("POSTGRES_USER"), password=os.getenv("POSTGRES_PASSWORD"),
+                                 host=os.getenv("POSTGRES_HOST"), port=os.getenv("POSTGRES_PORT"))
+   connection.autocommit = True
+   try:
+      with connection.cursor() as cursor:
+         cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(name)))
+         cursor.execute("SHOW server_version")
+         version = cursor.fetchone()[0]
+      yield name, version
+   finally:
+      with connection.cursor() as cursor:
+         cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE)").format(sql.Identifier(name)))
+      connection.close()
+
+
+#Body of the step processes. The API is imported here, after POSTGRES_DB points to the disposable database
+#The setup step only creates the tables, so its queries aren't counted on the first end-point
+def run_step(step, database, folder, rows, pipe):
+   os.environ["POSTGRES_DB"] = database
+   os.chdir(folder)
+   from api import create_app
+   from metrics import metrics
+   if step == "setup":
+      create_app()
+      pipe.send({})
+      return
+   client = create_app(setup=False).test_client()
+   method, url = STEPS[step]
+   startRss = peak_rss()
+   queries = metrics.total("db_queries_total")
+   start = time.perf_counter()
+   response = client.open(url, method=method)
+   body = response.get_data()
+   response.close()
+   seconds = time.perf_counter() - start
+   if rows is None:
+      #Rows of the report, without the CSV header
+      rows = body.count(b"\n") - 1
+   pipe.send({
+      "status": response.status_code,
+      "errors": body.count(b"ERROR"),
+      "seconds": round(seconds, 4),
+      "rows": rows,
+      "rows_per_second": round(rows / seconds, 1) if seconds else None,
+      "queries": metrics.total("db_queries_total") - queries,
+      "start_rss_mb": startRss,
+      "peak_rss_mb": peak_rss(),
+   })
+
+
+#Run a step in a new interpreter, so its peak RSS and query count only belong to that step
+def run(step, database, folder, rows=None):
+   context = multiprocessing.get_context("spawn")
+   receiver, sender = context.Pipe(duplex=False)
+   process = context.Process(target=run_step, args=(step, database, folder, rows, sender))
+   process.start()
+   sender.close()
+   try:
+      result = receiver.recv()
+   except EOFError:
+      process.join()
+      raise RuntimeError(f"The {step} step exited with code {process.exitcode}")
+   process.join()
+   return result
+
+
+#Steps slower, bigger or with more queries than on the baseline of the same scale
+#Times under min_seconds apart are noise and aren't reported
+def compare(result, baseline, tolerance, min_seconds=0.05):
+   previous = baseline.get(str(result["rows"]))
+   print(f"{'step':>22} {'seconds':>9} {'baseline':>9} {'change':>8} {'rows/s':>12} {'peak RSS':>9} {'queries':>8}")
+   regressions = []
+   for step, current in result["steps"].items():
+      old = previous["steps"].get(step) if previous else None
+      previousSeconds = f"{old['seconds']:.3f}" if old else "-"
+      change = f"{current['seconds'] / old['seconds'] - 1:>+8.0%}" if old and old["seconds"] else f"{'':>8}"
+      print(f"{step:>22} {current['seconds']:>9.3f} {previousSeconds:>9} {change} {current['rows_per_second'] or 0:>12,.0f} "
+            f"{current['peak_rss_mb']:>6.0f} MB {current['queries']:>8}")
+      if old is None:
+         continue
+      if current["seconds"] > old["seconds"] * (1 + tolerance) and current["seconds"] - old["seconds"] > min_seconds:
+         regressions.append(f"{step} took {current['seconds']:.3f}s, {old['seconds']:.3f}s on the baseline")
+      if current["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+         regressions.append(f"{step} peaked at {current['peak_rss_mb']} MB, {old['peak_rss_mb']} MB on the baseline")
+      if current["queries"] > old["queries"]:
+         regressions.append(f"{step} ran {current['queries']} queries, {old['queries']} on the baseline")
+   if previous is None:
+      print(f"No baseline for {result['rows']:,} rows, store one with --save-baseline")
+   return regressions
+
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="Benchmark the ingestion and report end-points on synthetic data")
+   parser.add_argument("rows", type=int, nargs="?", default=100000, help="historical employees, from 10k to 50M")
+   parser.add_argument("--new-rows", type=int, help="employees sent to insert_data, 10%% of rows by default")
+   parser.add_argument("--departments", type=int, default=12)
+   parser.add_argument("--jobs", type=int, default=183)
+   parser.add_argument("--null-rate", type=float, default=0.01, help="share of missing department and job ids")
+   parser.add_argument("--invalid-rate", type=float, default=0.005, help="share of department and job ids that don't exist")
+   parser.add_argument("--data", help="folder of the generated CSVs, kept and reused by later runs. A temporary folder by default")
+   parser.add_argument("--output", default="bench_results.json", help="JSON file of the results")
+   parser.add_argument("--baseline", default=BASELINE)
+   parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline of this scale")
+   parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown or RSS growth reported as a regression")
+   return parser.parse_args()
+
+
+def main(args, folder):
+   newRows = args.new_rows if args.new_rows is not None else max(args.rows // 10, 1)
+   start = time.perf_counter()
+   write_data(folder, args.rows, newRows, args.departments, args.jobs, args.null_rate, args.invalid_rate)
+   print(f"Data written in {time.perf_counter() - start:.1f}s to {folder}")
+
+   #Rows read by the ingestion end-points, the reports count the rows they return
+   rows = {step: sum(count_lines(os.path.join(folder, "data", kind, name)) for name in ["departments.csv", "jobs.csv", "hired_employees.csv"])
+           for step, kind in [("upload_historical_data", "Historical"), ("insert_data", "New")]}
+   with disposable_database() as (database, version):
+      run("setup", database, folder)
+      steps = {step: run(step, database, folder, rows.get(step)) for step in STEPS}
+
+   result = {
+      "rows": args.rows,
+      "new_rows": newRows,
+      "departments": args.departments,
+      "jobs": args.jobs,
+      "null_rate": args.null_rate,
+      "invalid_rate": args.invalid_rate,
+      "environment": {"python": platform.python_version(), "postgresql": version, "cpus": os.cpu_count(), "machine": platform.machine()},
+      "steps": steps,
+   }
+   with open(args.output, "w") as file:
+      json.dump(result, file, indent=2)
+
+   baseline = {}
+   if os.path.exists(args.baseline):
+      with open(args.baseline) as file:
+         baseline = json.load(file)
+   regressions = compare(result, baseline, args.tolerance)
+   if args.save_baseline:
+      baseline[str(args.rows)] = result
+      with open(args.baseline, "w") as file:
+         json.dump(baseline, file, indent=2)
+         file.write("\n")
+      print(f"Baseline of {args.rows:,} rows stored in {args.baseline}")
+      return 0
+   for regression in regressions:
+      print(f"REGRESSION: {regression}")
+   return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+   args = parse_args()
+   if args.data:
+      sys.exit(main(args, os.path.abspath(args.data)))
+   with tempfile.TemporaryDirectory() as folder:
+      sys.exit(main(args, folder))
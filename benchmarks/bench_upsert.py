@@ -0,0 +1,76 @@
+#Benchmark = Latency of a 1000 row employee upsert as the employee table grows, comparing the old read_sql + merge
+#            + multi-VALUES insert against the staging upsert used by insert_data
+#Usage: python benchmarks/bench_upsert.py [sizes...]
+#WARNING: it truncates the department, job and employee tables of the configured database
+import os
+import sys
+import time
+import random
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from api import db_URI, EmployeeSchema # noqa: E402
+from loader import upsert_frame, READ_DTYPES # noqa: E402
+from bench_historical_load import reset_tables # noqa: E402
+from sqlalchemy import create_engine # noqa: E402
+from sqlalchemy.orm import Session # noqa: E402
+from sqlalchemy.dialects.postgresql import insert # noqa: E402
+
+
+#Grow the employee table up to the given number of rows with server side generated data
+def grow_employees(engine, rows):
+   connection = engine.raw_connection()
+   with connection.cursor() as cursor:
+      cursor.execute("SELECT COALESCE(MAX(employee_id), 0) FROM employee")
+      start = cursor.fetchone()[0] + 1
+      cursor.execute("""INSERT INTO employee (employee_id, name, hired_at, department_id, job_id)
+                        SELECT g, 'Employee ' || g, '2021-06-15T10:00:00Z', (g %% 12) + 1, (g %% 183) + 1
+                        FROM generate_series(%s, %s) AS g""", (start, rows))
+      cursor.execute("ANALYZE employee")
+   connection.commit()
+   connection.close()
+
+
+#Batch of 1000 rows, half of them update existing employees and half of them are new
+def make_batch(size):
+   random.seed(size)
+   ids = [random.randint(1, size) for _ in range(500)] if size else []
+   ids = sorted(set(ids)) + list(range(size + 1, size + 1 + 1000 - len(set(ids))))
+   return pd.DataFrame({"employee_id": ids, "name": [f"Updated {i}" for i in ids], "hired_at": "2021-07-01T00:00:00Z", "department_id": 1, "job_id": 2}).astype(READ_DTYPES["employee"])
+
+
+#Upsert as insert_data did before: read the whole table, merge, and insert a multi-VALUES statement
+def old_upsert(engine, batch):
+   employeeHistorical = pd.read_sql('employee', engine)
+   matched = tuple(pd.merge(employeeHistorical, batch, on='employee_id', how='right')['employee_id'])
+   records = batch[batch['employee_id'].isin(matched)].to_dict("records")
+   with Session(engine) as session:
+      stmt = insert(EmployeeSchema).values(records)
+      stmt = stmt.on_conflict_do_update(index_elements=['employee_id'], set_={column: stmt.excluded[column] for column in ['name', 'hired_at', 'department_id', 'job_id']})
+      session.execute(stmt)
+      session.commit()
+
+
+def new_upsert(engine, batch):
+   connection = engine.raw_connection()
+   upsert_frame(connection, batch, 'employee')
+   connection.close()
+
+
+def timed(function, *args):
+   start = time.perf_counter()
+   function(*args)
+   return (time.perf_counter() - start) * 1000
+
+
+if __name__ == "__main__":
+   sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000, 1000000, 3000000]
+   engine = create_engine(db_URI)
+   reset_tables(engine)
+   print(f"{'employee rows':>14} {'old (ms)':>10} {'staging (ms)':>13}")
+   for size in sizes:
+      grow_employees(engine, size)
+      old = timed(old_upsert, engine, make_batch(size))
+      new = min(timed(new_upsert, engine, make_batch(size)) for _ in range(5))
+      print(f"{size:>14,} {old:>10.1f} {new:>13.1f}")
+   reset_tables(engine)
@@ -0,0 +1,83 @@
+#Load test = Requests/sec and latency of the SQL end-points under concurrent clients, on the Flask development server and on gunicorn with 1, 2 and 4 workers
+#Usage: python benchmarks/load_test.py [seconds] [clients] [workers...]
+#It needs the configured PostgreSQL with data loaded (POST /api/v1/upload_historical_data). The response cache is turned off so every request reaches the database
+import os
+import sys
+import time
+import subprocess
+import http.client
+import statistics
+import threading
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PORT = 5077
+PATHS = ["/api/v1/number-of-employees", "/api/v1/hired-per-department", "/api/v1/number-of-employees?year=2022&format=json"]
+
+
+def start_server(workers):
+   env = dict(os.environ, CACHE_MAX_BODY_BYTES="0", GUNICORN_BIND=f"127.0.0.1:{PORT}", GUNICORN_ACCESS_LOG="")
+   if workers == 0:
+      command = [sys.executable, "-c", f"import sys; sys.path.insert(0, 'src'); from api import create_app; create_app().run(port={PORT}, debug=True, use_reloader=False)"]
+   else:
+      env["WEB_CONCURRENCY"] = str(workers)
+      command = [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py"]
+   server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+   for _ in range(200):
+      try:
+         connection = http.client.HTTPConnection("127.0.0.1", PORT, timeout=1)
+         connection.request("GET", "/readyz")
+         if connection.getresponse().status == 200:
+            return server
+      except OSError:
+         pass
+      time.sleep(0.1)
+   server.kill()
+   raise RuntimeError("The server didn't get ready")
+
+
+#Every client keeps its connection open and sends requests one after the other until the time is over
+def client(deadline, latencies, errors):
+   connection = http.client.HTTPConnection("127.0.0.1", PORT, timeout=30)
+   i = 0
+   while time.perf_counter() < deadline:
+      start = time.perf_counter()
+      try:
+         connection.request("GET", PATHS[i % len(PATHS)])
+         response = connection.getresponse()
+         response.read()
+         if response.status != 200:
+            errors.append(response.status)
+         latencies.append(time.perf_counter() - start)
+      except (OSError, http.client.HTTPException):
+         errors.append("connection")
+         connection = http.client.HTTPConnection("127.0.0.1", PORT, timeout=30)
+      i += 1
+
+
+def run(seconds, clients):
+   latencies, errors = [], []
+   deadline = time.perf_counter() + seconds
+   threads = [threading.Thread(target=client, args=(deadline, latencies, errors)) for _ in range(clients)]
+   for thread in threads:
+      thread.start()
+   for thread in threads:
+      thread.join()
+   latencies.sort()
+   return len(latencies) / seconds, statistics.median(latencies) * 1000, latencies[int(len(latencies) * 0.95) - 1] * 1000, len(errors)
+
+
+if __name__ == "__main__":
+   seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+   clients = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+   counts = [int(workers) for workers in sys.argv[3:]] or [1, 2, 4]
+   print(f"CPU cores: {os.cpu_count()}, clients: {clients}, {seconds} s per server")
+   print(f"{'server':>22} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'errors':>7}")
+   for workers in [0] + counts:
+      server = start_server(workers)
+      try:
+         throughput, p50, p95, errors = run(seconds, clients)
+      finally:
+         server.terminate()
+         server.wait()
+      name = "Flask dev server" if workers == 0 else f"gunicorn {workers} worker{'s' if workers > 1 else ''}"
+      print(f"{name:>22} {throughput:>8.1f} {p50:>9.1f} {p95:>9.1f} {errors:>7}")
@@ -0,0 +1,30 @@
+#Settings of the production server: gunicorn --config gunicorn.conf.py
+#Every setting can be changed with the environment variables below
+import multiprocessing
+import os
+
+#The modules of the API are in src, the working directory stays on the repository root because the CSV paths are relative to it
+pythonpath = "src"
+wsgi_app = "api:create_app(setup=False)"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+
+#Worker processes, each one with its own engine and connection pool, and threads serving the requests of each worker
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+
+#Historical uploads can take a while, background jobs (/api/v1/jobs) don't hold a request at all
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 60))
+keepalive = 5
+
+#The app is created by every worker after the fork, so no engine or connection is shared between processes
+preload_app = False
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-") or None
+
+
+#Create the tables and apply the migrations once, on the master process before the workers start
+#The modules of the API are imported here, so the workers are forked with them already loaded
+def on_starting(server):
+   from api import create_app, setup_database
+   setup_database(create_app(setup=False))
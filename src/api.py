@@ -1,24 +1,34 @@
-from flask import Flask
+from flask import Blueprint, Flask, Response, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import create_engine
-from sqlalchemy.sql import text
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import OperationalError
 import pandas as pd
 import psycopg2
+import html
 from psycopg2 import sql
 import os
+import sys
+import traceback
 from dotenv import load_dotenv # type: ignore
 import warnings
+from cache import response_cache
+from reports import report_response
+from batches import BatchReport, body_rows, write_batches
+from jobs import jobs, historical_load, load_job, load_jobs, fail_orphaned_jobs
+from migrations import run_migrations, pending_migrations
+from pool import engine_options, pool_metrics, checkout
+from metrics import instrument, metrics, stage, timed_chunks
+from manifest import NEW, file_state, forget_files, recorded_files, is_unchanged, historical_changes, record_historical, save_file, forget_historical
+from loader import bulk_load_table, copy_csv_to_staging, reject_invalid_employees, format_rejected_rows, RejectedRows, insert_from_staging, rebuild_hire_summary, matches_schema, upsert_frame, UpsertError, progress, CHUNK_SIZE, BATCH_SIZE, TABLE_COLUMNS, READ_DTYPES
 
 
 load_dotenv()
-api = Flask(__name__)
 warnings.filterwarnings("ignore", category=FutureWarning)
 host, pgdatabase, port, pguser, password = os.getenv("POSTGRES_HOST"), os.getenv("POSTGRES_DB"), os.getenv("POSTGRES_PORT"), os.getenv("POSTGRES_USER"), os.getenv("POSTGRES_PASSWORD")
 db_URI = f'postgresql://{pguser}:{password}@{host}/{pgdatabase}'
-api.config["SQLALCHEMY_DATABASE_URI"] = db_URI
-api.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(api)
+#The engine is created for each app by create_app, and it opens its first connection on the first request, so every worker process has its own pool
+db = SQLAlchemy()
+#End-points of the API, registered on every app made by create_app
+routes = Blueprint("api", __name__)
 
 '''
 #Create PostgreSQL Database
@@ -58,27 +68,116 @@ class EmployeeSchema(db.Model):
    __tablename__ = 'employee'
    employee_id = db.Column(db.Integer, primary_key=True) #INTEGER Id of the employee
    name = db.Column(db.String(50), nullable=True) #STRING Name and surname of the employee
-   datetime = db.Column(db.String(20), nullable=True) #STRING Hire datetime in ISO format
+   hired_at = db.Column(db.DateTime(timezone=True), nullable=True) #TIMESTAMPTZ Hire datetime, loaded from the ISO format datetime of the CSV
    department_id = db.Column(db.Integer, db.ForeignKey('department.department_id'), nullable=True) #INTEGER Id of the department which the employee was hired for
    job_id = db.Column(db.Integer, db.ForeignKey('job.job_id'), nullable=True) #INTEGER Id of the job which the employee was hired for
 
-#Create tables on PostgreSQL based on Schemas.
-with api.app_context():
-   try:    
-      db.create_all()
-   except Exception:
-      print("PostgreSQL Username or password are incorrect - 401")
-      #Quit script if connection to PostreSQL is not properly set up
-      quit()
+#Hire Summary Schema
+#Number of employees hired for each year, quarter, department and job. It is kept up to date by the ingestion end-points and read by the SQL end-points
+#Employees without hire datetime, department or job are counted with NULL on those keys, so NULLs are not distinct on the unique constraint
+class HireSummarySchema(db.Model):
+   __tablename__ = 'hire_summary'
+   hire_summary_id = db.Column(db.Integer, primary_key=True) #INTEGER Id of the summary row
+   year = db.Column(db.Integer, nullable=True) #INTEGER Year of the hire datetime in UTC
+   quarter = db.Column(db.Integer, nullable=True) #INTEGER Quarter of the hire datetime in UTC
+   department_id = db.Column(db.Integer, nullable=True) #INTEGER Id of the department
+   job_id = db.Column(db.Integer, nullable=True) #INTEGER Id of the job
+   hires = db.Column(db.Integer, nullable=False) #INTEGER Number of employees hired
+   __table_args__ = (
+      db.UniqueConstraint('year', 'quarter', 'department_id', 'job_id', name='uq_hire_summary_key', postgresql_nulls_not_distinct=True),
+   )
+
+#Ingest Job Schema
+#Last saved status of each background job, so any worker process of the API can answer it
+class IngestJobSchema(db.Model):
+   __tablename__ = 'ingest_job'
+   job_id = db.Column(db.String(32), primary_key=True) #STRING Id of the job
+   kind = db.Column(db.String(50), nullable=False) #STRING Work done by the job
+   status = db.Column(db.String(20), nullable=False) #STRING Status of the job when it was saved
+   snapshot = db.Column(db.JSON, nullable=False) #JSON Status, progress and errors of the job, as returned by GET /api/v1/jobs/<id>
+   submitted_at = db.Column(db.DateTime(timezone=True), nullable=False) #TIMESTAMPTZ When the job was queued
+   updated_at = db.Column(db.DateTime(timezone=True), nullable=False) #TIMESTAMPTZ When the job was saved
+   owner_host = db.Column(db.String(255), nullable=True) #STRING Host name of the process running the job
+   owner_pid = db.Column(db.Integer, nullable=True) #INTEGER Id of the process running the job
+
+#Ingest Manifest Schema
+#Size, modification time and hash of every CSV file loaded, so the files that didn't change since are skipped
+class IngestManifestSchema(db.Model):
+   __tablename__ = 'ingest_manifest'
+   path = db.Column(db.String(500), primary_key=True) #STRING Absolute path of the file
+   source = db.Column(db.String(20), nullable=False) #STRING historical for data/Historical, new for data/New
+   size = db.Column(db.BigInteger, nullable=False) #BIGINT Size of the file in bytes when it was loaded
+   mtime = db.Column(db.Float, nullable=False) #FLOAT Modification time of the file when it was loaded
+   sha256 = db.Column(db.String(64), nullable=False) #STRING SHA-256 of the content of the file
+   rejected = db.Column(db.Integer, nullable=False) #INTEGER Employees of the file left out because their department or job didn't exist
+   loaded_at = db.Column(db.DateTime(timezone=True), nullable=False) #TIMESTAMPTZ When the file was loaded
+
+#Create tables on PostgreSQL based on Schemas and apply the pending migrations for tables created by older versions
+#It runs once before the worker processes start, so they don't have to wait for it or race each other
+def setup_database(app):
+   with app.app_context():
+      try:
+         db.create_all()
+         connection = db.engine.raw_connection()
+         try:
+            run_migrations(connection)
+         finally:
+            connection.close()
+         #No worker of this host runs jobs yet, so the unfinished jobs of this host belong to processes that are gone
+         fail_orphaned_jobs(db.engine, every=True)
+      except OperationalError as e:
+         #The connection itself failed: wrong username, password, host or database
+         print(f"PostgreSQL Username or password are incorrect - 401: {str(e.orig).strip()}")
+         #Quit script if connection to PostreSQL is not properly set up
+         sys.exit(1)
+      except Exception:
+         #Any other error comes from creating the tables or from a migration, it is printed as it is so it can be fixed
+         print("ERROR: The tables couldn't be created or migrated - 500")
+         traceback.print_exc()
+         sys.exit(1)
+      finally:
+         #Connections opened here must not be shared with forked worker processes
+         db.engine.dispose()
+
+#Year reported by the SQL end-points when the request doesn't ask for one
+REPORT_YEAR = 2021
+
+#Number of employees hired for each job and department in a year divided by quarter
+#It reads the hire_summary table, so its cost depends on the number of departments and jobs and not on the number of employees
+NUMBER_OF_EMPLOYEES_QUERY = sql.SQL("""SELECT de.department, jo.job,
+                              COALESCE(SUM(hs.hires) FILTER (WHERE hs.quarter = 1), 0)::BIGINT AS Q1,
+                              COALESCE(SUM(hs.hires) FILTER (WHERE hs.quarter = 2), 0)::BIGINT AS Q2,
+                              COALESCE(SUM(hs.hires) FILTER (WHERE hs.quarter = 3), 0)::BIGINT AS Q3,
+                              COALESCE(SUM(hs.hires) FILTER (WHERE hs.quarter = 4), 0)::BIGINT AS Q4
+                        FROM hire_summary AS hs
+                        LEFT JOIN department AS de ON hs.department_id = de.department_id 
+                        LEFT JOIN job AS jo ON hs.job_id = jo.job_id
+                        WHERE hs.year = %(year)s
+                        GROUP BY de.department, jo.job
+                        ORDER BY de.department, jo.job""")
+
+#Departments that hired more employees in a year than the mean of employees hired that year for all the departments
+#It reads the hire_summary table, so its cost depends on the number of departments and jobs and not on the number of employees
+HIRED_PER_DEPARTMENT_QUERY = sql.SQL("""WITH average AS (SELECT AVG(hires) AS average_hires FROM (SELECT department_id, SUM(hires) AS hires 
+                                                                                   FROM hire_summary 
+                                                                                   WHERE year = %(year)s AND department_id IS NOT NULL 
+                                                                                   GROUP BY department_id)),
+                              hired AS (SELECT department_id, SUM(hires) AS hired FROM hire_summary WHERE year = %(year)s GROUP BY department_id)
+                         SELECT hi.department_id, de.department, hi.hired::BIGINT AS hired
+                         FROM hired AS hi
+                         LEFT JOIN department AS de ON hi.department_id = de.department_id 
+                         WHERE hi.hired > (SELECT average_hires FROM average)
+                         ORDER BY hi.hired DESC""")
+
 
 #APIs Home
-@api.route("/")
+@routes.route("/")
 def home():
    return "<h1>Globant API<h1>"
 
 
 #End-point = Receive historical data from CSV files and upload them into postgreSQL DB named gproject
-@api.route("/api/v1/upload_historical_data", methods = ["GET", "POST"])
+@routes.route("/api/v1/upload_historical_data", methods = ["GET", "POST"])
 def upload_historical_data():
    
    #Define paths to the historical CSV
@@ -91,67 +190,103 @@ def upload_historical_data():
    
    #Check if both Job and Department tables where created
    primaryCheck = 0
-
-   #Create the database engine connection
-   engine = create_engine(db_URI)
+   #Check if the Employee table was loaded or had nothing to load
+   employeeCheck = 0
+   rejected = []
 
    #Check if the department path and job path with the historical CSVs exist
    if (os.path.exists(depPath) and os.path.exists(jobPath)):
       
       if (os.path.getsize(depPath)) != 0 and (os.path.getsize(jobPath)) != 0:
 
-         #Read path for historical data for Job and Department and create pandas dataframes based on those CSV
-         departments = pd.read_csv(depPath, names=["department_id", "department"])
-         jobs = pd.read_csv(jobPath, names=["job_id", "job"])
-
-         #Truncate all the tables to add new historical data
-         db.session.execute(text("TRUNCATE TABLE job,department,employee"))
-         db.session.commit()
-         
-         #Use pandas dataframe to write data into the PostgreSQL tables
+         #Skip the load when the files are the ones of the latest historical load and no data was written since, unless the request asks for ?force=true
+         paths = {"department": depPath, "job": jobPath}
+         if os.path.exists(empPath) and os.path.getsize(empPath) != 0:
+            paths["employee"] = empPath
+         connection = checkout(db.engine)
          try:
-            departments.to_sql('department', engine, if_exists='append', index=False)
-            status = status + "<p>Data uploaded to Department table successfully! - 200</p>"
-         except:
-            status = status + "<p>ERROR: Review the Department table Schema and the CSV file. Either the number of columns is different or the datatypes vary - 500</p>"
-            primaryCheck = 1
-         
+            with connection.cursor() as cursor:
+               states, unchanged = historical_changes(cursor, paths)
+            connection.commit()
+         finally:
+            connection.close()
+         if unchanged and request.args.get("force", "false").lower() != "true":
+            return "<p>Historical CSV files didn't change since the last upload and no data was written since. No data was changed - 200</p>"
+
+         #Every table is truncated and reloaded inside a single transaction, so readers never see a half loaded database
+         connection = checkout(db.engine)
          try:
-            jobs.to_sql('job', engine, if_exists='append', index=False)
-            status = status + "<p>Data uploaded to Job table successfully! - 200</p>"
-         except:
-            status = status + "<p>ERROR: Review the Job table Schema and the CSV file. Either the number of columns is different or the datatypes vary - 500</p>"
-            primaryCheck = 1
-
-         #Get valid IDs for job_id and department_id from their respective tables
-         job_valid_ids = tuple(jobs['job_id'])
-         dep_valid_ids = tuple(departments['department_id'])
-         
-         if os.path.exists(empPath):
-            if os.path.getsize(empPath) != 0:
-               if primaryCheck == 0:
-                  #Read path for historical data for employee and create pandas dataframe based on CSV
-                  employees = pd.read_csv(empPath, names=["employee_id", "name", "datetime", "department_id", "job_id"])
-
-                  #Create a dataframe with invalid IDS, ergo, IDs present in the employee CSV as Foreign Keys that don't actually exist in the job and department CSV as primary keys 
-                  emp_invalid = employees[(~employees['job_id'].isin(job_valid_ids) & employees['job_id'].notnull()) | (~employees['department_id'].isin(dep_valid_ids) & employees['department_id'].notnull())]
-                     
-                  #If there are invalid IDs, don't insert historical employee data
-                  if emp_invalid.size != 0:
-                     status = status + "<p>ERROR: Department ID or Job ID not valid. Foreign key constraint on Employee table not met. Check data and schema - 500</p>"
-                  #If there are no invalid IDs, insert historical employee data
+            with connection.cursor() as cursor:
+               #Truncate all the tables to add new historical data
+               with stage("truncate", "all"):
+                  cursor.execute("TRUNCATE TABLE job,department,employee")
+
+               #Stream each CSV into a staging table with COPY and move it into the PostgreSQL tables
+               try:
+                  bulk_load_table(cursor, depPath, 'department')
+                  status = status + "<p>Data uploaded to Department table successfully! - 200</p>"
+               except Exception:
+                  status = status + "<p>ERROR: Review the Department table Schema and the CSV file. Either the number of columns is different or the datatypes vary - 500</p>"
+                  primaryCheck = 1
+               
+               try:
+                  bulk_load_table(cursor, jobPath, 'job')
+                  status = status + "<p>Data uploaded to Job table successfully! - 200</p>"
+               except Exception:
+                  status = status + "<p>ERROR: Review the Job table Schema and the CSV file. Either the number of columns is different or the datatypes vary - 500</p>"
+                  primaryCheck = 1
+               
+               if os.path.exists(empPath):
+                  if os.path.getsize(empPath) != 0:
+                     if primaryCheck == 0:
+                        cursor.execute("SAVEPOINT employee")
+                        try:
+                           #Stage historical data for employee
+                           staging = copy_csv_to_staging(cursor, empPath, 'employee')
+
+                           #Remove the rows with IDs present in the employee CSV as Foreign Keys that don't actually exist in the job and department tables as primary keys
+                           rejected = reject_invalid_employees(cursor, staging)
+
+                           #Insert the valid historical employee data and report the CSV lines of the invalid one, so they can be fixed and inserted later
+                           rows = insert_from_staging(cursor, 'employee', staging)
+                           if len(rejected) != 0:
+                              status = status + f"<p>ERROR: Department ID or Job ID not valid on CSV rows {format_rejected_rows(rejected)}. Foreign key constraint on Employee table not met, those rows were not uploaded. The other {rows} rows were uploaded. Check data and schema - 500</p>"
+                           else:
+                              status = status + "<p>Data uploaded to Employee table successfully! - 200</p>"
+                        except Exception:
+                           cursor.execute("ROLLBACK TO SAVEPOINT employee")
+                           status = status + "<p>ERROR: Review the Employee table Schema and the CSV file. Either the number of columns is different or the datatypes vary - 500</p>"
+                           employeeCheck = 1
+                     else:
+                        status = status + "<p>ERROR: Either Job table or Department table couldn't be created. Given the foreign key constraints, the Employee table was not loaded - 500</p>"
                   else:
-                     try:
-                        employees.to_sql('employee', engine, if_exists='append', index=False)
-                        status = status + "<p>Data uploaded to Employee table successfully! - 200</p>"
-                     except:
-                        status = status + "<p>ERROR: Review the Employee table Schema and the CSV file. Either the number of columns is different or the datatypes vary - 500</p>"
+                     status = status + "<p>ERROR: Employee CSV is empty. No data was uploaded for the Employee table - 500</p>"
                else:
-                  status = status + "<p>ERROR: Either Job table or Department table couldn't be created. Given the foreign key constraints, no data was uploaded to the Employee table - 500</p>"
+                  status = status + "<p>ERROR: Employee CSV is not present on the path. No data was uploaded for the Employee table - 500</p>"
+
+               if primaryCheck == 0:
+                  #Count the hires of the new data for the SQL end-points
+                  rebuild_hire_summary(cursor)
+
+                  #Record the files once every table was loaded, the next upload of the same files is skipped. Files of data/New are loaded again after it
+                  if employeeCheck == 0:
+                     record_historical(cursor, paths, states, len(rejected))
+                  else:
+                     forget_files(cursor)
+            if primaryCheck == 0:
+               with stage("commit", "all"):
+                  connection.commit()
+               #Cached responses of the SQL end-points are outdated now
+               response_cache.invalidate()
             else:
-               status = status + "<p>ERROR: Employee CSV is empty. No data was uploaded for the Employee table - 500</p>"
-         else:
-            status = status + "<p>ERROR: Employee CSV is not present on the path. No data was uploaded for the Employee table - 500</p>"
+               #Without departments and jobs the truncate would leave the database empty, so the whole load is rolled back and the previous data is kept
+               connection.rollback()
+               status = status + "<p>ERROR: The historical load was rolled back. No data was changed - 500</p>"
+         except Exception:
+            connection.rollback()
+            status = "<p>ERROR: The historical load failed and was rolled back. No data was changed - 500</p>"
+         finally:
+            connection.close()
       else:
          status = status + "<p>ERROR: Job CSV or Department CSV are empty. No data was uploaded - 500</p>"
    else:
@@ -160,8 +295,59 @@ def upload_historical_data():
    return status
 
 
+#End-point = Queue the upload of the historical CSV files as a background job and return its id right away
+@routes.route("/api/v1/jobs/upload_historical_data", methods = ["POST"])
+def queue_historical_data():
+   #Define paths to the historical CSV
+   depPath = r"data/Historical/departments.csv"
+   jobPath = r"data/Historical/jobs.csv"
+   empPath = r"data/Historical/hired_employees.csv"
+
+   #Job and Department CSVs are needed, the Employee CSV is loaded when it is present and not empty
+   if not (os.path.exists(depPath) and os.path.exists(jobPath)):
+      return jsonify({"error": "Job CSV or Department CSV are not present on the path. No job was queued"}), 400
+   if os.path.getsize(depPath) == 0 or os.path.getsize(jobPath) == 0:
+      return jsonify({"error": "Job CSV or Department CSV are empty. No job was queued"}), 400
+   paths = {"department": depPath, "job": jobPath}
+   if os.path.exists(empPath) and os.path.getsize(empPath) != 0:
+      paths["employee"] = empPath
+
+   #The job finishes right away with unchanged set when the files are the ones of the latest historical load, unless the request asks for ?force=true
+   force = request.args.get("force", "false").lower() == "true"
+   job = jobs.submit("upload_historical_data", historical_load, db.engine, paths, force)
+   return jsonify(job.snapshot()), 202, {"Location": f"/api/v1/jobs/{job.id}"}
+
+
+#End-point = Status of the latest ingestion jobs. Jobs of this process are live, the ones of other worker processes are read as they were last saved
+@routes.route("/api/v1/jobs", methods = ["GET"])
+def list_jobs():
+   fail_orphaned_jobs(db.engine)
+   snapshots = {snapshot["id"]: snapshot for snapshot in load_jobs(db.engine)}
+   snapshots.update((job.id, job.snapshot()) for job in jobs.list())
+   return jsonify(sorted(snapshots.values(), key=lambda snapshot: snapshot["submitted_at"], reverse=True))
+
+
+#End-point = Status of an ingestion job, with the progress, rows/sec and errors of each of its tables
+@routes.route("/api/v1/jobs/<job_id>", methods = ["GET"])
+def job_status(job_id):
+   job = jobs.get(job_id)
+   if job is None:
+      fail_orphaned_jobs(db.engine)
+   snapshot = job.snapshot() if job is not None else load_job(db.engine, job_id)
+   if snapshot is None:
+      return jsonify({"error": f"Unknown job {job_id}"}), 404
+   return jsonify(snapshot)
+
+
+#Status of a table of insert_data that couldn't be written. Batches are committed one by one, so the ones before the error are kept
+def write_error(table, error):
+   if isinstance(error, UpsertError):
+      return f"<p>ERROR: The {table} table couldn't be written on CSV rows {error.first_row} to {error.last_row}: {html.escape(str(error))}. The rows before them were inserted and the rest of the file was not. Check data and schema - 500</p>"
+   return f"<p>ERROR: The new {table} CSV couldn't be read: {html.escape(str(error).strip())}. The rows read before the error were inserted and the rest of the file was not. Check data and schema - 500</p>"
+
+
 #End-point = Insert up to 1000 rows in batch transactions into postgreSQL DB named gproject
-@api.route("/api/v1/insert_data", methods = ["GET", "POST"])
+@routes.route("/api/v1/insert_data", methods = ["GET", "POST"])
 def insert_data():
    #Define paths to the new CSV that contain data that will be appended to the already created tables
    depPath = r"data/New/departments.csv"
@@ -172,160 +358,163 @@ def insert_data():
    iniStatus = "<p>No new files were found to insert batch data</p>"
    status = ""
    statusCheck = 0
+   #Check if a file was skipped because it didn't change since it was inserted
+   unchangedCheck = 0
+   force = request.args.get("force", "false").lower() == "true"
+
+   #Take a connection from the pool shared by every end-point
+   connection = checkout(db.engine)
+   try:
+      #Files inserted before with the same content are skipped, unless the request asks for ?force=true
+      #Files that changed are read again, but only their new and modified rows are written
+      with connection.cursor() as cursor:
+         recorded = recorded_files(cursor, NEW)
+      connection.commit()
 
-   #Create the database engine connection
-   engine = create_engine(db_URI)
-
-   #Check if the department path with the new CSV file exist
-   if os.path.exists(depPath):
-      if os.path.getsize(depPath) != 0:
-         statusCheck = 1
-         #Retrieve both historical file and the new file for departments
-         departmentNew = pd.read_csv(depPath, names=["department_id", "department"])
-         departmentHistorical = pd.read_sql('department', engine)
-
-         #Check if both dataframes have the same schema (Columns and datatypes)
-         if departmentNew.dtypes.equals(departmentHistorical.dtypes):
-
-            #JOIN both dataframes to see the IDs that match and new IDs
-            dep_matched_ids = tuple(pd.merge(departmentHistorical,departmentNew,on='department_id',how='right')['department_id'])
-            
-            
-            #Create new dataframe with just the IDs that matched and and convert data into a list of dictionaries
-            departmentUpdate = departmentNew[departmentNew['department_id'].isin(dep_matched_ids)]
-            depData = departmentUpdate.to_dict("records")
-
-            #For loop to upsert data into department table each 1000 records
-            for i in range(0, len(depData), 1000):
-               depBatch = depData[i:i+1000]
-
-               #Create statement object to insert and update on conflict
-               stmt = insert(DepartmentSchema).values(depBatch)
-               stmt = stmt.on_conflict_do_update(
-                  index_elements=['department_id'],
-                  set_={
-                     "department": stmt.excluded.department
-                  }
-               )
-
-               db.session.execute(stmt)
-               db.session.commit()
-            status = status + "<p>New records inserted into Department Table! - 200</p>"
-            
+      #Check if the department path with the new CSV file exist
+      if os.path.exists(depPath):
+         depState = file_state(depPath, recorded.get(os.path.abspath(depPath)))
+         if is_unchanged(depState, recorded.get(os.path.abspath(depPath))) and not force:
+            unchangedCheck = 1
+            status = status + "<p>New Department CSV didn't change since it was inserted. No data was changed - 200</p>"
+         elif os.path.getsize(depPath) != 0:
+            statusCheck = 1
+            schemaCheck = 1
+            forget_historical(connection)
+            progress.start('department')
+
+            error = None
+            try:
+               #Read the new file for departments in chunks, so memory doesn't grow with the size of the file
+               #The reader is closed with its file when the loop ends, a schema mismatch or an error included
+               with pd.read_csv(depPath, names=["department_id", "department"], dtype=READ_DTYPES['department'], chunksize=CHUNK_SIZE) as reader:
+                  for departmentNew in timed_chunks(reader, 'department'):
+
+                     #Check if the chunk has the same schema as the table (Columns and datatypes)
+                     if not matches_schema(departmentNew, 'department'):
+                        schemaCheck = 0
+                        break
+
+                     #Stage the chunk and upsert it on PostgreSQL, new IDs are inserted and IDs that already exist are updated
+                     upsert_frame(connection, departmentNew, 'department')
+                     progress.add('department', len(departmentNew))
+            except Exception as e:
+               error = write_error('Department', e)
+            finally:
+               progress.finish('department')
+
+            if error is not None:
+               status = status + error
+            elif schemaCheck == 1:
+               save_file(connection, depPath, depState, 0)
+               status = status + "<p>New records inserted into Department Table! - 200</p>"
+            else:
+               status = status + "<p>ERROR: The schema of the new Department CSV to insert, doesn't match the PostgreSQL table schema - 500</p>"
          else:
-            status = status + "<p>ERROR: The schema of the new Department CSV to insert, doesn't match the PostgreSQL table schema - 500</p>"
+            status = status + "<p>ERROR: New Department CSV is empty. No data was uploaded for the department table - 500</p>"
       else:
-         status = status + "<p>ERROR: New Department CSV is empty. No data was uploaded for the department table - 500</p>"
-   else:
-      pass
+         pass
    
-   #Check if the job path with the new CSV file exist
-   if os.path.exists(jobPath):
-      if os.path.getsize(jobPath) != 0:
-         statusCheck = 1
-         #Retrieve both historical file and the new file for jobs
-         jobNew = pd.read_csv(jobPath, names=["job_id", "job"])
-         jobHistorical = pd.read_sql('job', engine)
-
-         #Check if both dataframes have the same schema (Columns and datatypes)
-         if jobNew.dtypes.equals(jobHistorical.dtypes):
-
-            #JOIN both dataframes to see the IDs that match and new IDs
-            job_matched_ids = tuple(pd.merge(jobHistorical,jobNew, on='job_id',how='right')['job_id'])
-            
-            #Create new dataframe with just the IDs that matched and convert data into a list of dictionaries
-            jobUpdate = jobNew[jobNew['job_id'].isin(job_matched_ids)]
-            jobData = jobUpdate.to_dict("records")
-
-            #For loop to upsert data into job table each 1000 records
-            for i in range(0, len(jobData), 1000):
-               jobBatch = jobData[i:i+1000]
-
-               #Create statement object to insert and update on conflict
-               stmt = insert(JobSchema).values(jobBatch)
-               stmt = stmt.on_conflict_do_update(
-                  index_elements=['job_id'],
-                  set_={
-                     "job": stmt.excluded.job
-                  }
-               )
-
-               db.session.execute(stmt)
-               db.session.commit()
-            status = status + "<p>New records inserted into Job Table! - 200</p>"
-
+      #Check if the job path with the new CSV file exist
+      if os.path.exists(jobPath):
+         jobState = file_state(jobPath, recorded.get(os.path.abspath(jobPath)))
+         if is_unchanged(jobState, recorded.get(os.path.abspath(jobPath))) and not force:
+            unchangedCheck = 1
+            status = status + "<p>New Job CSV didn't change since it was inserted. No data was changed - 200</p>"
+         elif os.path.getsize(jobPath) != 0:
+            statusCheck = 1
+            schemaCheck = 1
+            forget_historical(connection)
+            progress.start('job')
+
+            error = None
+            try:
+               #Read the new file for jobs in chunks, so memory doesn't grow with the size of the file
+               with pd.read_csv(jobPath, names=["job_id", "job"], dtype=READ_DTYPES['job'], chunksize=CHUNK_SIZE) as reader:
+                  for jobNew in timed_chunks(reader, 'job'):
+
+                     #Check if the chunk has the same schema as the table (Columns and datatypes)
+                     if not matches_schema(jobNew, 'job'):
+                        schemaCheck = 0
+                        break
+
+                     #Stage the chunk and upsert it on PostgreSQL, new IDs are inserted and IDs that already exist are updated
+                     upsert_frame(connection, jobNew, 'job')
+                     progress.add('job', len(jobNew))
+            except Exception as e:
+               error = write_error('Job', e)
+            finally:
+               progress.finish('job')
+
+            if error is not None:
+               status = status + error
+            elif schemaCheck == 1:
+               save_file(connection, jobPath, jobState, 0)
+               status = status + "<p>New records inserted into Job Table! - 200</p>"
+            else:
+               status = status + "<p>ERROR: The schema of the new Job CSV to insert, doesn't match the PostgreSQL table schema - 500</p>"
          else:
-            status = status + "<p>ERROR: The schema of the new Job CSV to insert, doesn't match the PostgreSQL table schema - 500</p>"
+            status = status + "<p>ERROR: New Job CSV is empty. No data was uploaded for the job table - 500</p>"
       else:
-         status = status + "<p>ERROR: New Job CSV is empty. No data was uploaded for the job table - 500</p>"
-   else:
-      pass
-
-   #Check if the employee path with the new CSV file exist
-   if os.path.exists(empPath):
-      if os.path.getsize(empPath) != 0:
-         statusCheck = 1
-         #Retrieve both historical file and the new file for employees
-         employeeNew = pd.read_csv(empPath, names=["employee_id", "name", "datetime", "department_id", "job_id"], dtype={'department_id': float, 'job_id': float})
-         employeeHistorical = pd.read_sql('employee', engine)
-
-         #Replace every NaN with None so PostgreSQL can accept the data
-         employeeNew.loc[employeeNew['department_id'].isna(), 'department_id'] = ""
-         employeeNew['department_id'] = employeeNew['department_id'].replace('', None)
-
-         #Replace every NaN with None so PostgreSQL can accept the data
-         employeeNew.loc[employeeNew['job_id'].isna(), 'job_id'] = ""
-         employeeNew['job_id'] = employeeNew['job_id'].replace('', None)
-
-         #Check if both dataframes have the same schema (Columns and datatypes)
-         if employeeNew.dtypes[0:3].equals(employeeHistorical.dtypes[0:3]) & ((employeeHistorical.dtypes.department_id in ('float', 'int')) & (employeeHistorical.dtypes.job_id in ('float', 'int'))):
-
-            #Get valid IDs for job_id and department_id from their respective tables
-            job_valid_ids = tuple(pd.read_sql('job', engine)['job_id'])
-            dep_valid_ids = tuple(pd.read_sql('department', engine)['department_id'])
-            
-            #Create a dataframe with invalid IDS, ergo, IDs present in the employee CSV as Foreign Keys that don't actually exist in the job and department tables as primary keys 
-            emp_invalid = employeeNew[(~employeeNew['job_id'].isin(job_valid_ids) & employeeNew['job_id'].notnull()) | (~employeeNew['department_id'].isin(dep_valid_ids) & employeeNew['department_id'].notnull())]
-            
-            #If there are invalid IDs, don't insert new employee data
-            if emp_invalid.size != 0:
-               status = status + "<p>Department ID or Job ID not valid. Foreign key constraint on Employee table not met. Check data and schema - 500</p>"
-            #If there are no invalid IDs, insert new employee data
-            else:  
-               #JOIN both dataframes to see the IDs that match and new IDs 
-               employee_matched_ids = tuple(pd.merge(employeeHistorical,employeeNew, on='employee_id',how='right')['employee_id'])
-
-               #Create new dataframe with just the IDs that matched and convert data into a list of dictionaries
-               empUpdate = employeeNew[employeeNew['employee_id'].isin(employee_matched_ids)]
-               empData = empUpdate.to_dict("records")
-
-               #For loop to upsert data into job table each 1000 records
-               for i in range(0, len(empData), 1000):
-                  empBatch = empData[i:i+1000]
-
-                  #Create statement object to insert and update on conflict
-                  stmt = insert(EmployeeSchema).values(empBatch)
-                  stmt = stmt.on_conflict_do_update(
-                     index_elements=['employee_id'],
-                     set_={
-                        "name": stmt.excluded.name,
-                        "datetime": stmt.excluded.datetime,
-                        "department_id": stmt.excluded.department_id,
-                        "job_id": stmt.excluded.job_id
-                     }
-                  )
-
-                  db.session.execute(stmt)
-                  db.session.commit()
+         pass
+
+      #Check if the employee path with the new CSV file exist
+      if os.path.exists(empPath):
+         empState = file_state(empPath, recorded.get(os.path.abspath(empPath)))
+         if is_unchanged(empState, recorded.get(os.path.abspath(empPath))) and not force:
+            unchangedCheck = 1
+            status = status + "<p>New Employee CSV didn't change since it was inserted. No data was changed - 200</p>"
+         elif os.path.getsize(empPath) != 0:
+            statusCheck = 1
+            schemaCheck = 1
+            forget_historical(connection)
+            rows = 0
+            rejected = RejectedRows()
+            progress.start('employee')
+
+            error = None
+            try:
+               #Read the new file for employees in chunks, so memory doesn't grow with the size of the file
+               with pd.read_csv(empPath, names=["employee_id", "name", "hired_at", "department_id", "job_id"], dtype=READ_DTYPES['employee'], chunksize=CHUNK_SIZE) as reader:
+                  for employeeNew in timed_chunks(reader, 'employee'):
+
+                     #Check if the chunk has the same schema as the table (Columns and datatypes)
+                     if not matches_schema(employeeNew, 'employee'):
+                        schemaCheck = 0
+                        break
+
+                     #Stage the chunk and upsert it on PostgreSQL, new IDs are inserted and IDs that already exist are updated
+                     #Rows with IDs that don't exist in the job and department tables as primary keys are checked on PostgreSQL and left out
+                     chunkRows, chunkRejected = upsert_frame(connection, employeeNew, 'employee')
+                     rows = rows + chunkRows
+                     rejected.extend(chunkRejected)
+                     progress.add('employee', len(employeeNew))
+            except Exception as e:
+               error = write_error('Employee', e)
+            finally:
+               progress.finish('employee')
+
+            if error is None and schemaCheck == 1:
+               save_file(connection, empPath, empState, rejected.count)
+            if error is not None:
+               status = status + error
+            elif schemaCheck == 0:
+               status = status + "<p>ERROR: The schema of the new Employee CSV to insert, doesn't match the PostgreSQL table schema</p>"
+            elif rejected.count != 0:
+               status = status + f"<p>Department ID or Job ID not valid on CSV rows {format_rejected_rows(rejected.rows, total=rejected.count)}. Foreign key constraint on Employee table not met, those rows were not inserted. The other {rows} rows were inserted. Check data and schema - 500</p>"
+            else:
                status = status + "<p>New records inserted in Employee table!</p>"
          else:
-            status = status + "<p>ERROR: The schema of the new Employee CSV to insert, doesn't match the PostgreSQL table schema</p>"
+            status = status + "<p>ERROR: New Employee CSV is empty. No data was uploaded for the employee table - 500</p>"
       else:
-         status = status + "<p>ERROR: New Employee CSV is empty. No data was uploaded for the employee table - 500</p>"
-   else:
-      pass
-
-   if statusCheck == 0:
+         pass
+   finally:
+      connection.close()
+      #Batches are committed one by one, so even a failed request may have changed the data and outdated the cached responses
+      if statusCheck == 1:
+         response_cache.invalidate()
+
+   if statusCheck == 0 and unchangedCheck == 0:
       finalStatus = iniStatus
    else:
       finalStatus = status
@@ -333,75 +522,143 @@ def insert_data():
    return finalStatus
 
 
-#End-point = Number of employees hired for each job and department in 2021 divided by quarter. The table must be ordered alphabetically by department and job.
-@api.route("/api/v1/number-of-employees", methods = ["GET"])
-def number_of_employees():
-   #Create PostgreSQL connection
-   connection = psycopg2.connect(
-      database = pgdatabase,
-      user = pguser,
-      password = password,
-      host = host,
-      port = port
-   )
-   with connection.cursor() as cursor:
-      query = sql.SQL("""SELECT de.department, jo.job, 
-                              SUM(CASE WHEN CAST(SUBSTRING(em.datetime,6,2) AS INT) BETWEEN 1 AND 3 THEN 1 ELSE 0 END) AS Q1,
-                              SUM(CASE WHEN CAST(SUBSTRING(em.datetime,6,2) AS INT) BETWEEN 4 AND 6 THEN 1 ELSE 0 END) AS Q2,
-                              SUM(CASE WHEN CAST(SUBSTRING(em.datetime,6,2) AS INT) BETWEEN 7 AND 9 THEN 1 ELSE 0 END) AS Q3,
-                              SUM(CASE WHEN CAST(SUBSTRING(em.datetime,6,2) AS INT) BETWEEN 10 AND 12 THEN 1 ELSE 0 END) AS Q4
-                        FROM employee AS em 
-                        LEFT JOIN department AS de ON em.department_id = de.department_id 
-                        LEFT JOIN job AS jo ON em.job_id = jo.job_id
-                        WHERE SUBSTRING(em.datetime,1,4) = '2021'
-                        GROUP BY de.department, jo.job
-                        ORDER BY de.department, jo.job""")
-      cursor.execute(query)
-      connection.commit()
-      rows = cursor.fetchall()
-   connection.close()
+#End-point = Insert the rows sent on the request body (CSV, JSON or JSON lines) into a table, in batch transactions of up to 1000 rows
+@routes.route("/api/v1/<table>/batch", methods = ["POST"])
+def insert_batch(table):
+   if table not in TABLE_COLUMNS:
+      return jsonify({"error": f"Unknown table {table}. Use one of {', '.join(TABLE_COLUMNS)}"}), 404
 
-   #Create basic HTML code to display query results in a table
-   result = "<table border='1'><tr><th>DEPARTMENT</th><th>JOB</th><th>Q1</th><th>Q2</th><th>Q3</th><th>Q4</th></tr>"
-   for row in rows:
-      result = result + f"""<tr><td>{row[0]}</td><td>{row[1]}</td><td>{row[2]}</td><td>{row[3]}</td><td>{row[4]}</td><td>{row[5]}</td></tr>"""
-   return result+"</table>"
+   #Rows per transaction, 1000 unless the request asks for less with ?batch_size=
+   batchSize = request.args.get("batch_size", BATCH_SIZE, type=int)
+   if not 1 <= batchSize <= BATCH_SIZE:
+      return jsonify({"error": f"batch_size must be between 1 and {BATCH_SIZE}"}), 400
 
+   rows = body_rows(TABLE_COLUMNS[table])
+   if rows is None:
+      return jsonify({"error": "Send the rows as text/csv, application/json or application/x-ndjson"}), 415
 
-#End-point = List of ids, name and number of employees hired of each department that hired more employees than the mean of employees 
-#            hired in 2021 for all the departments, ordered by the number of employees hired (descending).
-@api.route("/api/v1/hired-per-department", methods = ["GET"])
-def hired_per_department():
-   #Create PostgreSQL connection
-   connection = psycopg2.connect(
-      database = pgdatabase,
-      user = pguser,
-      password = password,
-      host = host,
-      port = port
-   )
-   with connection.cursor() as cursor:
-      query = sql.SQL("""WITH average AS (SELECT AVG(hires) AS average_hires FROM (SELECT department_id, COUNT(*) AS hires 
-                                                                                   FROM employee 
-                                                                                   WHERE SUBSTRING(datetime,1,4) = '2021' AND department_id IS NOT NULL 
-                                                                                   GROUP BY department_id))
-                         SELECT em.department_id, de.department, COUNT(em.employee_id) AS hired
-                         FROM employee AS em
-                         LEFT JOIN department AS de ON em.department_id = de.department_id 
-                         GROUP BY em.department_id, de.department
-                         HAVING COUNT(em.employee_id) > (SELECT average_hires FROM average)
-                         ORDER BY hired DESC;""")
-      cursor.execute(query)
+   report = BatchReport(table)
+   connection = checkout(db.engine)
+   try:
+      #A batch can overwrite rows of any file loaded before, so the whole manifest is forgotten and the next loads write them again
+      with connection.cursor() as cursor:
+         forget_files(cursor)
       connection.commit()
-      rows = cursor.fetchall()
-   connection.close()
+      write_batches(connection, rows, table, batchSize, report)
+   except (ValueError, psycopg2.Error) as e:
+      #The batches committed before the error are kept and listed on the response
+      return jsonify(dict(report.summary(), error=str(e).strip())), 400
+   finally:
+      connection.close()
+      if report.batches:
+         response_cache.invalidate()
+
+   return jsonify(report.summary())
+
+
+#End-point = Usage of the connection pool shared by every end-point and time spent waiting for a connection
+@routes.route("/api/v1/pool", methods = ["GET"])
+def pool_usage():
+   return jsonify(pool_metrics.snapshot(db.engine))
+
+
+#End-point = Hits and misses of the response cache of the SQL end-points
+@routes.route("/api/v1/cache", methods = ["GET"])
+def cache_usage():
+   return jsonify(response_cache.stats())
+
+
+#End-point = Rows processed for each table by the latest historical upload or batch insert
+@routes.route("/api/v1/progress", methods = ["GET"])
+def load_progress():
+   return jsonify(progress.snapshot())
+
+
+#End-point = Request latencies, ingestion stages, rows processed and query timings of this worker process in the Prometheus text format
+#The pool and cache usage are added as gauges
+@routes.route("/metrics", methods = ["GET"])
+def prometheus_metrics():
+   pool = pool_metrics.snapshot(db.engine)
+   cache = response_cache.stats()
+   gauges = [
+      ("db_pool_checked_out", "Connections of the pool in use", pool["checked_out"]),
+      ("db_pool_idle", "Connections of the pool waiting to be used", pool["idle"]),
+      ("db_pool_checkout_wait_max_seconds", "Longest wait for a connection of the pool", pool["checkout_wait_max_ms"] / 1000),
+      ("cache_hits", "Requests of the SQL end-points answered from the cache", cache["hits"]),
+      ("cache_misses", "Requests of the SQL end-points that ran their query", cache["misses"]),
+      ("cache_entries", "Responses stored in the cache", cache["entries"]),
+   ]
+   return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+#End-point = Number of employees hired for each job and department in 2021 (or the year given with ?year=) divided by quarter. The table must be ordered alphabetically by department and job.
+@routes.route("/api/v1/number-of-employees", methods = ["GET"])
+@response_cache.cached
+def number_of_employees():
+   #Year to report, 2021 unless the request asks for another one with ?year=
+   year = request.args.get("year", REPORT_YEAR, type=int)
 
-   #Create basic HTML code to display query results in a table
-   result = "<table border='1'><tr><th>ID</th><th>DEPARTMENT ID</th><th>HIRED</th></tr>"
-   for row in rows:
-      result = result + f"""<tr><td>{row[0]}</td><td>{row[1]}</td><td>{row[2]}</td></tr>"""
-   return result+"</table>"
+   #Stream the rows in the format asked by the client: HTML table (default), JSON lines, CSV or Arrow
+   #db.engine needs the app context, which is gone by the time the rows are sent, so the engine is taken here
+   engine = db.engine
+   return report_response(lambda: checkout(engine), NUMBER_OF_EMPLOYEES_QUERY, {"year": year},
+                          ["department", "job", "q1", "q2", "q3", "q4"], ["DEPARTMENT", "JOB", "Q1", "Q2", "Q3", "Q4"],
+                          ["string", "string", "int64", "int64", "int64", "int64"])
 
 
+#End-point = List of ids, name and number of employees hired of each department that hired more employees than the mean of employees 
+#            hired in 2021 for all the departments, ordered by the number of employees hired (descending).
+@routes.route("/api/v1/hired-per-department", methods = ["GET"])
+@response_cache.cached
+def hired_per_department():
+   #Year used for the mean of employees hired, 2021 unless the request asks for another one with ?year=
+   year = request.args.get("year", REPORT_YEAR, type=int)
+
+   #Stream the rows in the format asked by the client: HTML table (default), JSON lines, CSV or Arrow
+   #db.engine needs the app context, which is gone by the time the rows are sent, so the engine is taken here
+   engine = db.engine
+   return report_response(lambda: checkout(engine), HIRED_PER_DEPARTMENT_QUERY, {"year": year},
+                          ["department_id", "department", "hired"], ["ID", "DEPARTMENT ID", "HIRED"], ["int32", "string", "int64"])
+
+
+#End-point = Liveness of the worker process, it doesn't touch the database
+@routes.route("/healthz", methods = ["GET"])
+def healthz():
+   return jsonify({"status": "ok"})
+
+
+#End-point = Readiness to serve requests: PostgreSQL answers through the pool and every migration is applied
+@routes.route("/readyz", methods = ["GET"])
+def readyz():
+   try:
+      connection = checkout(db.engine)
+      try:
+         pending = pending_migrations(connection)
+      finally:
+         connection.close()
+   except Exception as e:
+      return jsonify({"status": "unavailable", "error": str(e).strip()}), 503
+   if pending:
+      return jsonify({"status": "migrating", "pending_migrations": pending}), 503
+   return jsonify({"status": "ready"})
+
+
+#App factory. Production servers call it in every worker process with setup=False, after setup_database ran once (see gunicorn.conf.py)
+def create_app(setup=True):
+   app = Flask(__name__)
+   app.config["SQLALCHEMY_DATABASE_URI"] = db_URI
+   app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+   #Every end-point takes its connections from the pool of this single engine
+   app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+   db.init_app(app)
+   app.register_blueprint(routes)
+   #Latency of every request, and a cProfile of the ones sent with X-Profile: 1 when PROFILE_REQUESTS is true
+   instrument(app)
+   if setup:
+      setup_database(app)
+   return app
+
+
+#Development server. Use gunicorn (see gunicorn.conf.py and the Dockerfile) to serve the API in production
 if __name__ == "__main__":
-  api.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+  create_app().run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,116 @@
+from flask import request
+from loader import write_batch, progress, RejectedRows
+import csv
+import io
+import json
+import time
+
+
+#Read the rows of a CSV body. Like the challenge files it has no header and its columns are in the order of the table
+#Empty fields are sent as NULL
+def read_csv_rows(stream, columns):
+   for line, fields in enumerate(csv.reader(stream), start=1):
+      if len(fields) != len(columns):
+         raise ValueError(f"Line {line} has {len(fields)} fields, {len(columns)} were expected ({', '.join(columns)})")
+      yield {column: value if value != "" else None for column, value in zip(columns, fields)}
+
+
+#Read the rows of a JSON body, an array with an object per row
+def read_json_rows(stream, columns):
+   rows = json.load(stream)
+   if not isinstance(rows, list):
+      raise ValueError("The JSON body must be an array of rows")
+   for line, row in enumerate(rows, start=1):
+      yield check_row(row, columns, line)
+
+
+#Read the rows of a JSON lines body, an object per line. Empty lines are skipped
+def read_ndjson_rows(stream, columns):
+   for line, text in enumerate(stream, start=1):
+      if text.strip():
+         yield check_row(json.loads(text), columns, line)
+
+
+#Check that a JSON row is an object with no columns other than the ones of its table
+def check_row(row, columns, line):
+   if not isinstance(row, dict):
+      raise ValueError(f"Row {line} is not a JSON object")
+   unknown = set(row) - set(columns)
+   if unknown:
+      raise ValueError(f"Row {line} has unknown columns {', '.join(sorted(unknown))}")
+   return row
+
+
+#Readers of the media types accepted by the batch API
+BODY_FORMATS = {
+   "text/csv": read_csv_rows,
+   "application/json": read_json_rows,
+   "application/x-ndjson": read_ndjson_rows,
+}
+
+
+#Pick the reader of the request body from its Content-Type, None when the type isn't supported
+#CSV and JSON lines bodies are read while they arrive, so the size of a request doesn't change the memory it uses
+def body_rows(columns):
+   reader = BODY_FORMATS.get(request.mimetype)
+   if reader is None:
+      return None
+   return reader(io.TextIOWrapper(request.stream, encoding="utf-8", newline=""), columns)
+
+
+#Group the rows into batches of batch_size, every row keeps its position on the body as row_number
+def group_batches(rows, batch_size):
+   batch = []
+   for number, row in enumerate(rows, start=1):
+      batch.append(dict(row, row_number=number))
+      if len(batch) == batch_size:
+         yield batch
+         batch = []
+   if batch:
+      yield batch
+
+
+#Latency and throughput of every batch written by a request of the batch API
+class BatchReport:
+   def __init__(self, table):
+      self.table = table
+      self.start = time.perf_counter()
+      self.batches = []
+      self.rejected = RejectedRows()
+
+   def add(self, rows, written, rejected, seconds):
+      self.batches.append({
+         "batch": len(self.batches) + 1,
+         "rows": rows,
+         "written": written,
+         "rejected": len(rejected),
+         "seconds": round(seconds, 6),
+         "rows_per_second": round(rows / seconds, 1) if seconds else None,
+      })
+      self.rejected.extend(rejected)
+
+   def summary(self):
+      seconds = time.perf_counter() - self.start
+      rows = sum(batch["rows"] for batch in self.batches)
+      return {
+         "table": self.table,
+         "rows": rows,
+         "written": sum(batch["written"] for batch in self.batches),
+         "rejected": self.rejected.count,
+         "rejected_rows": self.rejected.rows,
+         "seconds": round(seconds, 6),
+         "rows_per_second": round(rows / seconds, 1) if seconds else None,
+         "batches": self.batches,
+      }
+
+
+#Write the rows in transactions of batch_size rows. Every transaction is committed on its own, a failed batch stops the request
+#but the batches committed before it are kept
+def write_batches(connection, rows, table, batch_size, report):
+   progress.start(table)
+   for batch in group_batches(rows, batch_size):
+      start = time.perf_counter()
+      written, rejected = write_batch(connection, batch, table)
+      report.add(len(batch), written, rejected, time.perf_counter() - start)
+      progress.add(table, len(batch))
+   progress.finish(table)
@@ -0,0 +1,176 @@
+from flask import Response, request
+from collections import OrderedDict
+import base64
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+
+
+#Bodies bigger than this are streamed to the client but not cached
+MAX_BODY_BYTES = int(os.getenv("CACHE_MAX_BODY_BYTES", 1024 * 1024))
+
+
+#Local stand-in of the cache backend. It keeps the entries of this process in LRU order
+#The data version is kept in shared memory, so worker processes forked from the same server see the writes of each other
+class LocalCacheBackend:
+   def __init__(self, max_entries=256):
+      self.lock = threading.Lock()
+      self.max_entries = max_entries
+      self.entries = OrderedDict()
+      self.data_version = multiprocessing.Value("q", 0)
+
+   def get(self, key):
+      with self.lock:
+         if key not in self.entries:
+            return None
+         self.entries.move_to_end(key)
+         return self.entries[key]
+
+   def set(self, key, value):
+      with self.lock:
+         self.entries[key] = value
+         self.entries.move_to_end(key)
+         #Evict the least recently used entries when the cache is full
+         while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+   def version(self):
+      return self.data_version.value
+
+   def bump_version(self):
+      with self.data_version.get_lock():
+         self.data_version.value += 1
+         version = self.data_version.value
+      with self.lock:
+         #Entries of older versions can't be read anymore, drop them right away
+         self.entries.clear()
+      return version
+
+   def size(self):
+      with self.lock:
+         return len(self.entries)
+
+
+#Redis cache backend, shared by every worker process. Redis evicts the entries with its own LRU policy, entries also expire after a while
+class RedisCacheBackend:
+   def __init__(self, url, ttl=3600):
+      #Redis is an optional dependency, it is only needed when CACHE_URL is set
+      import redis
+      self.client = redis.Redis.from_url(url)
+      self.ttl = ttl
+
+   def get(self, key):
+      value = self.client.get(f"response:{key}")
+      if value is None:
+         return None
+      entry = json.loads(value)
+      entry["body"] = base64.b64decode(entry["body"])
+      return entry
+
+   def set(self, key, value):
+      entry = dict(value, body=base64.b64encode(value["body"]).decode())
+      self.client.set(f"response:{key}", json.dumps(entry), ex=self.ttl)
+
+   def version(self):
+      return int(self.client.get("data_version") or 0)
+
+   def bump_version(self):
+      return self.client.incr("data_version")
+
+   def size(self):
+      return None
+
+
+#Choose the cache backend from the environment variables: Redis when CACHE_URL is set, the local stand-in otherwise
+def create_cache_backend():
+   if os.getenv("CACHE_URL"):
+      return RedisCacheBackend(os.getenv("CACHE_URL"), ttl=int(os.getenv("CACHE_TTL", 3600)))
+   return LocalCacheBackend(max_entries=int(os.getenv("CACHE_MAX_ENTRIES", 256)))
+
+
+#Cache of the responses of the SQL end-points. Entries are keyed by the data version, the end-point and its query parameters,
+#so every write that bumps the data version makes the previous entries unreachable
+class ResponseCache:
+   def __init__(self, backend):
+      self.backend = backend
+      self.lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+
+   #The Accept header is part of the key because it chooses the format of the response
+   def key(self, version):
+      arguments = "&".join(f"{name}={value}" for name, value in sorted(request.args.items(multi=True)))
+      return f"{version}:{request.path}?{arguments}:{request.headers.get('Accept', '')}"
+
+   def count(self, hit):
+      with self.lock:
+         if hit:
+            self.hits += 1
+         else:
+            self.misses += 1
+
+   #Called by the ingestion end-points once their data is committed
+   def invalidate(self):
+      return self.backend.bump_version()
+
+   def stats(self):
+      with self.lock:
+         hits, misses = self.hits, self.misses
+      return {
+         "hits": hits,
+         "misses": misses,
+         "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else 0,
+         "entries": self.backend.size(),
+         "data_version": self.backend.version(),
+      }
+
+   #Pass the chunks of a streamed body to the client and keep a copy, which is cached once the whole body was sent
+   #The copy is dropped if the body grows over MAX_BODY_BYTES or the client goes away before the end
+   def store_streamed(self, key, chunks, mimetype):
+      body = []
+      size = 0
+      try:
+         for chunk in chunks:
+            yield chunk
+            if body is not None:
+               data = chunk.encode() if isinstance(chunk, str) else chunk
+               size += len(data)
+               if size <= MAX_BODY_BYTES:
+                  body.append(data)
+               else:
+                  body = None
+         if body is not None:
+            body = b"".join(body)
+            self.backend.set(key, {"body": body, "mimetype": mimetype, "etag": hashlib.sha1(body).hexdigest()})
+      finally:
+         close = getattr(chunks, "close", None)
+         if close is not None:
+            close()
+
+   #Decorator for end-points whose response only depends on the data, the query parameters and the Accept header
+   #Cached responses carry an ETag, so clients sending If-None-Match with an unchanged payload get an empty 304
+   def cached(self, endpoint):
+      @functools.wraps(endpoint)
+      def wrapper(*args, **kwargs):
+         #The version is read before the query runs, so a write committed meanwhile can't be cached as current data
+         key = self.key(self.backend.version())
+         entry = self.backend.get(key)
+         self.count(entry is not None)
+         if entry is None:
+            response = endpoint(*args, **kwargs)
+            #Only successful responses are cached, they are sent while they are being copied
+            if response.status_code == 200:
+               response.response = self.store_streamed(key, response.response, response.mimetype)
+            return response
+
+         response = Response(entry["body"], mimetype=entry["mimetype"])
+         response.vary.add("Accept")
+         response.set_etag(entry["etag"])
+         return response.make_conditional(request)
+      return wrapper
+
+
+response_cache = ResponseCache(create_cache_backend())
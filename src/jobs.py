@@ -0,0 +1,311 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime, timezone
+from psycopg2 import sql
+from cache import response_cache
+from pool import checkout
+from metrics import stage
+from manifest import historical_changes, record_historical
+from loader import LoadProgress, create_load_table, copy_csv_range, shard_count, split_csv, shard_line, reject_invalid_employees, insert_from_staging, rebuild_hire_summary
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+#Jobs run at the same time, the rest wait on the queue. Every job also takes a connection per table it loads
+JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", 2))
+
+#Host of this process, saved with every job along with the id of the process running it
+HOSTNAME = socket.gethostname()
+
+#Finished jobs kept in memory and listed by GET /api/v1/jobs, the oldest ones are forgotten first. Every job stays on the ingest_job table
+MAX_FINISHED_JOBS = 100
+
+
+#Progress of the tables of a job, with the rows/sec of every table and the errors it found
+class JobProgress(LoadProgress):
+   def __init__(self):
+      super().__init__()
+      self.times = {}
+      self.errors = {}
+
+   def start(self, table):
+      super().start(table)
+      with self.lock:
+         self.times[table] = [time.perf_counter(), None]
+
+   def finish(self, table):
+      super().finish(table)
+      with self.lock:
+         self.times[table][1] = time.perf_counter()
+
+   def fail(self, table, error):
+      with self.lock:
+         self.errors[table] = str(error).strip()
+
+   def snapshot(self):
+      tables = super().snapshot()
+      with self.lock:
+         for table, counters in tables.items():
+            start, end = self.times[table]
+            seconds = (end or time.perf_counter()) - start
+            counters["seconds"] = round(seconds, 6)
+            counters["rows_per_second"] = round(counters["rows"] / seconds, 1) if seconds else None
+         for table, error in self.errors.items():
+            tables.setdefault(table, {})["error"] = error
+      return tables
+
+
+def now():
+   return datetime.now(timezone.utc).isoformat()
+
+
+#Ingestion work queued on the worker pool. status goes from queued to running (or one of the steps of the job) and ends on succeeded or failed
+#The job is saved on the ingest_job table on every change of status, so the other worker processes can answer its status too
+class Job:
+   def __init__(self, kind, engine):
+      self.id = uuid.uuid4().hex
+      self.kind = kind
+      self.engine = engine
+      self.status = "queued"
+      self.error = None
+      self.rejected = []
+      self.unchanged = False
+      self.progress = JobProgress()
+      self.submitted_at = now()
+      self.started_at = None
+      self.finished_at = None
+
+   def snapshot(self):
+      return {
+         "id": self.id,
+         "kind": self.kind,
+         "status": self.status,
+         "error": self.error,
+         "submitted_at": self.submitted_at,
+         "started_at": self.started_at,
+         "finished_at": self.finished_at,
+         "tables": self.progress.snapshot(),
+         "unchanged": self.unchanged,
+         "rejected": len(self.rejected),
+         "rejected_rows": self.rejected[:100],
+      }
+
+   def set_status(self, status):
+      self.status = status
+      if status in ("succeeded", "failed"):
+         self.finished_at = now()
+      save_job(self)
+
+
+#Worker pool of the ingestion jobs. Jobs live in the memory of the process that queued them, no broker is needed
+class JobQueue:
+   def __init__(self, workers):
+      self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+      self.lock = threading.Lock()
+      self.jobs = OrderedDict()
+
+   #Queue function(job, engine, *args) and return its job right away
+   def submit(self, kind, function, engine, *args):
+      job = Job(kind, engine)
+      with self.lock:
+         self.jobs[job.id] = job
+         self.forget_finished()
+      save_job(job)
+      self.executor.submit(self.run, job, function, args)
+      return job
+
+   def run(self, job, function, args):
+      job.started_at = now()
+      try:
+         job.set_status("running")
+         function(job, job.engine, *args)
+         job.set_status("succeeded")
+      except Exception as e:
+         job.error = str(e).strip()
+         job.set_status("failed")
+
+   def get(self, job_id):
+      with self.lock:
+         return self.jobs.get(job_id)
+
+   def list(self):
+      with self.lock:
+         return list(self.jobs.values())
+
+   def forget_finished(self):
+      finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+      for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+         del self.jobs[job_id]
+
+
+jobs = JobQueue(JOB_WORKERS)
+
+
+#Save the snapshot of a job on the ingest_job table. The live status is kept by the process running the job,
+#so a failure to save it doesn't stop the job, the other processes just see an older status
+def save_job(job):
+   snapshot = job.snapshot()
+   try:
+      connection = checkout(job.engine)
+      try:
+         with connection.cursor() as cursor:
+            cursor.execute("""INSERT INTO ingest_job (job_id, kind, status, snapshot, submitted_at, updated_at, owner_host, owner_pid) VALUES (%s, %s, %s, %s, %s, now(), %s, %s)
+                              ON CONFLICT (job_id) DO UPDATE SET status = EXCLUDED.status, snapshot = EXCLUDED.snapshot, updated_at = now(),
+                                                                 owner_host = EXCLUDED.owner_host, owner_pid = EXCLUDED.owner_pid""",
+                           (job.id, job.kind, job.status, json.dumps(snapshot), job.submitted_at, HOSTNAME, os.getpid()))
+         connection.commit()
+      finally:
+         connection.close()
+   except Exception:
+      pass
+
+
+def process_alive(pid):
+   try:
+      os.kill(pid, 0)
+   except ProcessLookupError:
+      return False
+   except PermissionError:
+      return True
+   return True
+
+
+#Jobs live in the process that queued them, so a worker restarted by gunicorn (timeout, deploy, max_requests) leaves its jobs unfinished on ingest_job
+#Mark as failed the unfinished jobs of this host whose process is gone, or every unfinished job of this host when every is true,
+#as the master process does on start up. Jobs of other hosts can't be checked from here and are left as they are
+def fail_orphaned_jobs(engine, every=False):
+   connection = checkout(engine)
+   try:
+      with connection.cursor() as cursor:
+         cursor.execute("""SELECT job_id, owner_pid, snapshot FROM ingest_job WHERE owner_host = %s AND status NOT IN ('succeeded', 'failed')
+                           FOR UPDATE SKIP LOCKED""", (HOSTNAME,))
+         for job_id, pid, snapshot in cursor.fetchall():
+            if not every and (pid is None or process_alive(pid)):
+               continue
+            snapshot.update(status="failed", error=f"The process running the job ({HOSTNAME}, pid {pid}) stopped before the job finished", finished_at=now())
+            cursor.execute("UPDATE ingest_job SET status = 'failed', snapshot = %s, updated_at = now() WHERE job_id = %s", (json.dumps(snapshot), job_id))
+      connection.commit()
+   finally:
+      connection.close()
+
+
+#Saved snapshot of a job, None when there is no such job
+def load_job(engine, job_id):
+   connection = checkout(engine)
+   try:
+      with connection.cursor() as cursor:
+         cursor.execute("SELECT snapshot FROM ingest_job WHERE job_id = %s", (job_id,))
+         row = cursor.fetchone()
+      connection.commit()
+   finally:
+      connection.close()
+   return row[0] if row else None
+
+
+#Saved snapshots of the latest jobs
+def load_jobs(engine, limit=MAX_FINISHED_JOBS):
+   connection = checkout(engine)
+   try:
+      with connection.cursor() as cursor:
+         cursor.execute("SELECT snapshot FROM ingest_job ORDER BY submitted_at DESC LIMIT %s", (limit,))
+         rows = cursor.fetchall()
+      connection.commit()
+   finally:
+      connection.close()
+   return [row[0] for row in rows]
+
+
+#Copy a shard of a CSV into its child of the load table, on its own connection, and return the number of rows copied
+def copy_shard(job, engine, path, table, name, shard, start, end):
+   connection = checkout(engine)
+   try:
+      with connection.cursor() as cursor:
+         rows = copy_csv_range(cursor, path, table, f"{name}_{shard}", start, end, job.progress)
+      connection.commit()
+      return rows
+   except Exception:
+      connection.rollback()
+      raise
+   finally:
+      connection.close()
+
+
+#Stage a CSV into its load table and return the rows copied on each shard. Big files are split in shards copied at the same time,
+#so PostgreSQL parses and checks their rows on several cores. Errors are kept on the job progress instead of raised, so the other tables go on
+def stage_table(job, engine, path, table, name):
+   try:
+      ranges = split_csv(path, shard_count(path))
+      connection = checkout(engine)
+      try:
+         with connection.cursor() as cursor:
+            create_load_table(cursor, table, name, len(ranges))
+         connection.commit()
+      finally:
+         connection.close()
+
+      job.progress.start(table)
+      with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+         rows = list(executor.map(lambda shard: copy_shard(job, engine, path, table, name, shard, *ranges[shard]), range(len(ranges))))
+      job.progress.finish(table)
+      return rows
+   except Exception as e:
+      job.progress.fail(table, e)
+      return None
+
+
+#Historical load of a job. The CSVs of every table are staged in parallel, and the employees are validated against the staged departments and jobs
+#The tables are only truncated once every file was staged, and they are replaced on a single transaction, so a failed load never changes the data
+#Files that didn't change since the latest historical load are skipped, when no data was written since and force isn't set
+def historical_load(job, engine, paths, force=False):
+   connection = checkout(engine)
+   try:
+      with connection.cursor() as cursor:
+         states, unchanged = historical_changes(cursor, paths)
+      connection.commit()
+   finally:
+      connection.close()
+   if unchanged and not force:
+      job.unchanged = True
+      return
+
+   names = {table: f"{table}_load_{job.id[:12]}" for table in paths}
+   try:
+      job.set_status("staging")
+      with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+         shards = dict(zip(paths, executor.map(lambda table: stage_table(job, engine, paths[table], table, names[table]), paths)))
+      if None in shards.values():
+         raise RuntimeError(f"The CSV of {', '.join(job.progress.errors)} couldn't be staged. No data was changed")
+
+      job.set_status("writing")
+      connection = checkout(engine)
+      try:
+         with connection.cursor() as cursor:
+            if "employee" in names:
+               rejected = reject_invalid_employees(cursor, names["employee"], names["department"], names["job"])
+               job.rejected = [shard_line(row, shards["employee"]) for row in rejected]
+            with stage("truncate", "all"):
+               cursor.execute("TRUNCATE TABLE job,department,employee")
+            for table, name in names.items():
+               insert_from_staging(cursor, table, name)
+            rebuild_hire_summary(cursor)
+            record_historical(cursor, paths, states, len(job.rejected))
+         with stage("commit", "all"):
+            connection.commit()
+      except Exception:
+         connection.rollback()
+         raise
+      finally:
+         connection.close()
+      response_cache.invalidate()
+   finally:
+      connection = checkout(engine)
+      try:
+         with connection.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP TABLE IF EXISTS {} CASCADE").format(sql.SQL(", ").join(map(sql.Identifier, names.values()))))
+         connection.commit()
+      finally:
+         connection.close()
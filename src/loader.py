@@ -0,0 +1,459 @@
+from psycopg2 import sql
+from metrics import metrics, stage
+import io
+import json
+import os
+import threading
+
+
+#Number of CSV rows read, validated and written at a time. Memory used by a load depends on this value, not on the file size
+CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", 10000))
+
+#Rows written per transaction by insert_data, the challenge allows batch transactions from 1 up to 1000 rows
+BATCH_SIZE = 1000
+
+#synchronous_commit of the transactions of the batch API. Every batch reported as committed survives a crash by default. With off, COMMIT returns
+#before its WAL is flushed to disk, so the flush of a batch overlaps the work of the next ones. A crash can then lose the last batches reported
+#as committed, but never leaves a batch half written
+BATCH_SYNCHRONOUS_COMMIT = os.getenv("BATCH_SYNCHRONOUS_COMMIT", "on")
+
+#Size in bytes of each block sent to PostgreSQL by COPY
+COPY_BLOCK_SIZE = 64 * 1024
+
+#Shards a CSV is split in by the background jobs, each one copied on its own connection, and the smallest shard worth a connection
+#One shard by default: the only measurement so far, on a single core, shows the shards slower than a single COPY
+COPY_SHARDS = int(os.getenv("INGEST_COPY_SHARDS", 1))
+SHARD_MIN_BYTES = int(os.getenv("INGEST_SHARD_MIN_BYTES", 16 * 1024 * 1024))
+
+#The row_number of a sharded load table keeps the shard on its high bits and the line inside the shard on the low ones
+SHARD_BITS = 40
+
+#Columns of each table, in the same order as they appear on the CSV files
+TABLE_COLUMNS = {
+   "department": ["department_id", "department"],
+   "job": ["job_id", "job"],
+   "employee": ["employee_id", "name", "hired_at", "department_id", "job_id"],
+}
+
+#Pandas datatypes every chunk read from the CSV files must have to match the PostgreSQL table schema
+TABLE_DTYPES = {
+   "department": {"department_id": "int64", "department": "object"},
+   "job": {"job_id": "int64", "job": "object"},
+   "employee": {"employee_id": "int64", "name": "object", "hired_at": "object", "department_id": "Int64", "job_id": "Int64"},
+}
+
+#Datatypes the CSV columns are read with. Foreign keys can be missing, they are read as nullable integers. Text columns are pinned to object,
+#otherwise a chunk where every value of the column is empty is read as float64 and fails matches_schema halfway through a file
+READ_DTYPES = {
+   "department": {"department": "object"},
+   "job": {"job": "object"},
+   "employee": {"name": "object", "hired_at": "object", "department_id": "Int64", "job_id": "Int64"},
+}
+
+
+#Check if the columns and datatypes of a chunk match the schema of its table
+def matches_schema(chunk, table):
+   expected = TABLE_DTYPES[table]
+   return all(column in chunk.columns and str(chunk.dtypes[column]) == dtype for column, dtype in expected.items())
+
+
+#Rows processed for each table on the latest load. Loads can run in different threads, so every update holds a lock
+class LoadProgress:
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.tables = {}
+
+   def start(self, table):
+      with self.lock:
+         self.tables[table] = {"rows": 0, "chunks": 0, "done": False}
+
+   def add(self, table, rows):
+      with self.lock:
+         self.tables[table]["rows"] += rows
+         self.tables[table]["chunks"] += 1
+      metrics.inc("ingest_rows_total", rows, table=table)
+
+   def finish(self, table):
+      with self.lock:
+         self.tables[table]["done"] = True
+
+   def snapshot(self):
+      with self.lock:
+         return {table: dict(counters) for table, counters in self.tables.items()}
+
+
+progress = LoadProgress()
+
+
+#File wrapper handed to COPY. It counts the rows of every block read so the progress of the load can be followed
+class ProgressReader:
+   def __init__(self, file, table, tracker=progress):
+      self.file = file
+      self.table = table
+      self.tracker = tracker
+      self.last = b""
+
+   def read(self, size=-1):
+      block = self.file.read(size)
+      if block:
+         self.tracker.add(self.table, block.count(b"\n"))
+         self.last = block[-1:]
+      elif self.last not in (b"", b"\n"):
+         #The last line of the file has no line break, it is counted when the end of the file is reached
+         self.tracker.add(self.table, 1)
+         self.last = b""
+      return block
+
+   def readline(self, size=-1):
+      line = self.file.readline(size)
+      if line:
+         self.tracker.add(self.table, 1)
+      return line
+
+
+#Create a temporary staging table with the same columns as the target table. It is dropped when the transaction ends
+#The extra row_number column keeps the CSV line of every staged row, COPY fills it in file order when it isn't sent
+def create_staging_table(cursor, table):
+   staging = f"{table}_staging"
+   cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging)))
+   cursor.execute(sql.SQL("CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP").format(sql.Identifier(staging), sql.Identifier(table)))
+   cursor.execute(sql.SQL("ALTER TABLE {} ADD COLUMN row_number BIGINT GENERATED BY DEFAULT AS IDENTITY").format(sql.Identifier(staging)))
+   return staging
+
+
+#Create an unlogged table with the same columns as the target table plus row_number. Unlike the temporary staging tables it can be
+#read from any connection, so several tables can be staged at the same time and moved into their tables later on a single transaction
+#Rows are copied into one child table per shard, named {name}_{shard}, and read and deleted through the parent table
+def create_load_table(cursor, table, name, shards=1):
+   cursor.execute(sql.SQL("CREATE UNLOGGED TABLE {} (LIKE {}, row_number BIGINT)").format(sql.Identifier(name), sql.Identifier(table)))
+   for shard in range(shards):
+      cursor.execute(sql.SQL("CREATE UNLOGGED TABLE {} (row_number BIGINT GENERATED BY DEFAULT AS IDENTITY (START WITH {})) INHERITS ({})").format(
+         sql.Identifier(f"{name}_{shard}"), sql.Literal((shard << SHARD_BITS) + 1), sql.Identifier(name)))
+   return name
+
+
+#Number of shards for a CSV file, one per SHARD_MIN_BYTES up to COPY_SHARDS
+def shard_count(path):
+   return max(1, min(COPY_SHARDS, os.path.getsize(path) // SHARD_MIN_BYTES))
+
+
+#Split a CSV file into byte ranges of about the same size that end at line breaks, so every range holds whole lines
+#Quoted fields with line breaks would be cut, the CSV files of the challenge have none
+def split_csv(path, shards):
+   size = os.path.getsize(path)
+   bounds = [0]
+   with open(path, "rb") as file:
+      for shard in range(1, shards):
+         file.seek(max(size * shard // shards, bounds[-1]))
+         file.readline()
+         if file.tell() < size:
+            bounds.append(file.tell())
+   bounds.append(size)
+   return list(zip(bounds[:-1], bounds[1:]))
+
+
+#File wrapper that only reads the byte range [start, end) of a file opened in binary mode. COPY takes the bytes as they are
+class RangeReader:
+   def __init__(self, file, start, end):
+      self.file = file
+      self.file.seek(start)
+      self.left = end - start
+
+   def read(self, size=-1):
+      size = self.left if size < 0 else min(size, self.left)
+      block = self.file.read(size)
+      self.left -= len(block)
+      return block
+
+   def readline(self, size=-1):
+      size = self.left if size < 0 else min(size, self.left)
+      line = self.file.readline(size)
+      self.left -= len(line)
+      return line
+
+
+#CSV line of a row_number of a sharded load table, given the rows copied on each shard
+def shard_line(row_number, shard_rows):
+   shard = row_number >> SHARD_BITS
+   return sum(shard_rows[:shard]) + (row_number & ((1 << SHARD_BITS) - 1))
+
+
+#Stream a CSV file into a staging table with COPY FROM STDIN. The file is sent in blocks of COPY_BLOCK_SIZE, it is never fully loaded in memory
+def copy_csv(cursor, path, table, staging, tracker=progress):
+   tracker.start(table)
+   copy_csv_range(cursor, path, table, staging, 0, os.path.getsize(path), tracker)
+   tracker.finish(table)
+   return staging
+
+
+#Stream the lines of the byte range [start, end) of a CSV file into a staging table with COPY, and return the number of rows copied
+def copy_csv_range(cursor, path, table, staging, start, end, tracker=progress):
+   columns = sql.SQL(", ").join(map(sql.Identifier, TABLE_COLUMNS[table]))
+   query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(sql.Identifier(staging), columns)
+   with open(path, "rb") as file, stage("copy", table):
+      cursor.copy_expert(query.as_string(cursor), ProgressReader(RangeReader(file, start, end), table, tracker), size=COPY_BLOCK_SIZE)
+   return cursor.rowcount
+
+
+def copy_csv_to_staging(cursor, path, table):
+   return copy_csv(cursor, path, table, create_staging_table(cursor, table))
+
+
+#Remove from the staging table the employees whose job_id or department_id don't exist as primary keys on the job and department tables
+#The anti-join runs on PostgreSQL with the primary key indexes, and the CSV line of every removed row is returned in order
+#The keys can also be checked against other tables, such as the staged departments and jobs of a load that isn't written yet
+def reject_query(staging, department="department", job="job"):
+   return sql.SQL("""DELETE FROM {} AS st
+                     WHERE (st.job_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {} AS jo WHERE jo.job_id = st.job_id))
+                        OR (st.department_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {} AS de WHERE de.department_id = st.department_id))
+                     RETURNING st.row_number""").format(sql.Identifier(staging), sql.Identifier(job), sql.Identifier(department))
+
+
+def reject_invalid_employees(cursor, staging="employee_staging", department="department", job="job"):
+   with stage("validate", "employee"):
+      cursor.execute(reject_query(staging, department, job))
+      rejected = sorted(row[0] for row in cursor.fetchall())
+   metrics.inc("ingest_rejected_rows_total", len(rejected), table="employee")
+   return rejected
+
+
+#Rejected CSV lines listed on the responses, the rest are only counted
+REJECTED_LIMIT = 100
+
+
+#Rejected CSV lines of a load read in chunks or batches. Only the first REJECTED_LIMIT lines are kept, so memory doesn't grow with the file
+class RejectedRows:
+   def __init__(self, limit=REJECTED_LIMIT):
+      self.limit = limit
+      self.rows = []
+      self.count = 0
+
+   def extend(self, rows):
+      self.rows.extend(rows[:self.limit - len(self.rows)])
+      self.count += len(rows)
+
+
+#Describe rejected CSV lines for the end-point status, listing at most the first 100 of them. total counts the lines that weren't kept
+def format_rejected_rows(rejected, limit=REJECTED_LIMIT, total=None):
+   total = len(rejected) if total is None else total
+   listed = rejected[:limit]
+   rows = ", ".join(str(row) for row in listed)
+   if total > len(listed):
+      rows = rows + f" and {total - len(listed)} more"
+   return rows
+
+
+#Move every staged row into the target table and return the number of rows written
+def insert_from_staging(cursor, table, staging):
+   columns = sql.SQL(", ").join(map(sql.Identifier, TABLE_COLUMNS[table]))
+   query = sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(sql.Identifier(table), columns, columns, sql.Identifier(staging))
+   with stage("insert", table):
+      cursor.execute(query)
+   return cursor.rowcount
+
+
+#Keys of the hire_summary table for a set of employees. Year and quarter are taken in UTC, like the CSV datetimes
+HIRE_KEYS = """EXTRACT(YEAR FROM em.hired_at AT TIME ZONE 'UTC')::INT AS year, EXTRACT(QUARTER FROM em.hired_at AT TIME ZONE 'UTC')::INT AS quarter,
+               em.department_id, em.job_id"""
+
+
+#Count again every hire of the employee table into hire_summary, used after the historical load replaces all the data
+def rebuild_hire_summary(cursor):
+   with stage("hire_summary", "employee"):
+      cursor.execute("TRUNCATE TABLE hire_summary")
+      cursor.execute(f"""INSERT INTO hire_summary (year, quarter, department_id, job_id, hires)
+                         SELECT {HIRE_KEYS}, COUNT(*) FROM employee AS em GROUP BY 1, 2, 3, 4""")
+
+
+#Key of the transaction-level advisory lock taken by every batch before it reads the employees it updates in hire_summary
+HIRE_SUMMARY_LOCK = 2021
+
+#Statements that update hire_summary for a staged batch before it is upserted. Only the keys of the batch are touched, so the cost depends on the batch size
+#Employees that already exist are taken out of the keys of their current data, then every staged employee is added to the keys of its new data
+#Both go through the uq_hire_summary_key index with ON CONFLICT. The previous hires are added as negative counts, so a key that is missing shows up negative
+#Batches that write the same employees at the same time would both take out the same previous hires, so the batches update hire_summary one at a time
+def hire_summary_queries(staging):
+   return {
+      "lock_hires": sql.SQL("SELECT pg_advisory_xact_lock({})").format(sql.Literal(HIRE_SUMMARY_LOCK)),
+      "previous_hires": sql.SQL(f"""INSERT INTO hire_summary (year, quarter, department_id, job_id, hires)
+                                     SELECT {HIRE_KEYS}, -COUNT(*) FROM employee AS em JOIN {{}} AS st ON st.employee_id = em.employee_id GROUP BY 1, 2, 3, 4
+                                     ON CONFLICT (year, quarter, department_id, job_id) DO UPDATE SET hires = hire_summary.hires + EXCLUDED.hires""").format(sql.Identifier(staging)),
+      "empty_hires": sql.SQL("DELETE FROM hire_summary WHERE hires = 0"),
+      "new_hires": sql.SQL(f"""INSERT INTO hire_summary (year, quarter, department_id, job_id, hires)
+                                SELECT {HIRE_KEYS}, COUNT(*) FROM {{}} AS em GROUP BY 1, 2, 3, 4
+                                ON CONFLICT (year, quarter, department_id, job_id) DO UPDATE SET hires = hire_summary.hires + EXCLUDED.hires""").format(sql.Identifier(staging)),
+   }
+
+
+def update_hire_summary(cursor, staging="employee_staging"):
+   with stage("hire_summary", "employee"):
+      for query in hire_summary_queries(staging).values():
+         cursor.execute(query)
+
+
+#Load a CSV into its table through a staging table inside a savepoint, so a failure only discards the rows of that table
+def bulk_load_table(cursor, path, table):
+   cursor.execute(sql.SQL("SAVEPOINT {}").format(sql.Identifier(table)))
+   try:
+      staging = copy_csv_to_staging(cursor, path, table)
+      rows = insert_from_staging(cursor, table, staging)
+   except Exception:
+      cursor.execute(sql.SQL("ROLLBACK TO SAVEPOINT {}").format(sql.Identifier(table)))
+      raise
+   return rows
+
+
+#Encode the rows of a dataframe as the CSV read by COPY, with the row_number first. Missing values are written as empty fields, which COPY reads as NULL
+#The dataframe index is the position of the row on the CSV file, it is sent as the row_number of every row
+#Arrow writes the CSV from the column buffers without a Python object per row. pandas writes the same CSV when pyarrow isn't installed
+def frame_to_csv(frame, table):
+   rowNumbers = frame.index.to_numpy() + 1
+   try:
+      #pyarrow is pinned in requirements.txt, the fallback only keeps the loader working where it can't be imported
+      import pyarrow as pa
+      import pyarrow.csv
+   except ImportError:
+      buffer = io.StringIO()
+      frame.set_axis(rowNumbers).to_csv(buffer, header=False, index=True, columns=TABLE_COLUMNS[table])
+      return io.BytesIO(buffer.getvalue().encode("utf-8"))
+   columns = pa.Table.from_pandas(frame[TABLE_COLUMNS[table]], preserve_index=False).add_column(0, "row_number", pa.array(rowNumbers))
+   sink = pa.BufferOutputStream()
+   pyarrow.csv.write_csv(columns, sink, pyarrow.csv.WriteOptions(include_header=False))
+   return pa.BufferReader(sink.getvalue())
+
+
+#Write a dataframe into a staging table with COPY
+def copy_frame_to_staging(cursor, frame, table):
+   staging = create_staging_table(cursor, table)
+   columns = sql.SQL(", ").join(map(sql.Identifier, ["row_number"] + TABLE_COLUMNS[table]))
+   query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(sql.Identifier(staging), columns)
+   with stage("encode", table):
+      rows = frame_to_csv(frame, table)
+   with stage("copy", table):
+      cursor.copy_expert(query.as_string(cursor), rows)
+   return staging
+
+
+#Insert the staged rows and update the ones whose primary key already exists. The rest of the table is never read
+def upsert_query(table, staging):
+   key, *others = TABLE_COLUMNS[table]
+   columns = sql.SQL(", ").join(map(sql.Identifier, TABLE_COLUMNS[table]))
+   updates = sql.SQL(", ").join(sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(column), sql.Identifier(column)) for column in others)
+   return sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT ({}) DO UPDATE SET {}").format(sql.Identifier(table), columns, columns, sql.Identifier(staging), sql.Identifier(key), updates)
+
+
+def upsert_from_staging(cursor, table, staging):
+   with stage("upsert", table):
+      cursor.execute(upsert_query(table, staging))
+   return cursor.rowcount
+
+
+#Remove from the staging table the rows that are already stored with the same values, and return how many were removed
+#A file loaded again only writes its new and modified rows, so replaying it doesn't write the table, hire_summary or the WAL
+def unchanged_query(table, staging):
+   key = sql.Identifier(TABLE_COLUMNS[table][0])
+   stored = sql.SQL(", ").join(sql.SQL("ta.{}").format(sql.Identifier(column)) for column in TABLE_COLUMNS[table])
+   staged = sql.SQL(", ").join(sql.SQL("st.{}").format(sql.Identifier(column)) for column in TABLE_COLUMNS[table])
+   return sql.SQL("DELETE FROM {} AS st USING {} AS ta WHERE ta.{} = st.{} AND ({}) IS NOT DISTINCT FROM ({})").format(
+      sql.Identifier(staging), sql.Identifier(table), key, key, stored, staged)
+
+
+def skip_unchanged_rows(cursor, table, staging):
+   with stage("unchanged", table):
+      cursor.execute(unchanged_query(table, staging))
+   metrics.inc("ingest_unchanged_rows_total", cursor.rowcount, table=table)
+   return cursor.rowcount
+
+
+#Error of a batch of upsert_frame. The batches before it are committed, first_row and last_row are the CSV lines of the batch that failed
+class UpsertError(Exception):
+   def __init__(self, table, first_row, last_row, error):
+      super().__init__(str(error).strip())
+      self.table = table
+      self.first_row = first_row
+      self.last_row = last_row
+
+
+#Upsert a dataframe into its table each BATCH_SIZE rows, every batch is staged and committed in its own transaction
+#Employees with foreign keys that don't exist are left out, their CSV lines are returned along with the number of rows written
+#Rows already stored with the same values aren't written again
+#The hire_summary table is updated in the same transaction as the employees of the batch
+def upsert_frame(connection, frame, table):
+   rows = 0
+   rejected = []
+   for i in range(0, len(frame), BATCH_SIZE):
+      batch = frame.iloc[i:i+BATCH_SIZE]
+      try:
+         with connection.cursor() as cursor:
+            staging = copy_frame_to_staging(cursor, batch, table)
+            if table == "employee":
+               rejected.extend(reject_invalid_employees(cursor, staging))
+            skip_unchanged_rows(cursor, table, staging)
+            if table == "employee":
+               update_hire_summary(cursor, staging)
+            rows += upsert_from_staging(cursor, table, staging)
+         with stage("commit", table):
+            connection.commit()
+      except Exception as e:
+         connection.rollback()
+         raise UpsertError(table, batch.index[0] + 1, batch.index[-1] + 1, e) from e
+   return rows, rejected
+
+
+#Statements of the batch API for a table. A batch is filled into a temporary {table}_batch table from a JSON array of rows,
+#then the same steps as upsert_frame run on it
+def batch_queries(table):
+   batch = f"{table}_batch"
+   queries = {"fill": sql.SQL("INSERT INTO {} SELECT * FROM json_populate_recordset(NULL::{}, $1::json)").format(sql.Identifier(batch), sql.Identifier(batch))}
+   if table == "employee":
+      queries["reject"] = reject_query(batch)
+      queries.update(hire_summary_queries(batch))
+   queries["upsert"] = upsert_query(table, batch)
+   return queries
+
+
+#Create the batch tables and prepare the statements of the batch API once per pooled connection, so their plans are reused by every batch
+#The batch tables live as long as the connection and are emptied on every commit. The pool clears connection.info when it opens a new connection
+def prepare_batch_statements(connection):
+   if connection.info.get("batch_statements"):
+      return
+   with connection.cursor() as cursor:
+      cursor.execute("DEALLOCATE ALL")
+      for table in TABLE_COLUMNS:
+         batch = sql.Identifier(f"{table}_batch")
+         cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(batch))
+         cursor.execute(sql.SQL("CREATE TEMP TABLE {} (LIKE {}, row_number BIGINT) ON COMMIT DELETE ROWS").format(batch, sql.Identifier(table)))
+         for step, query in batch_queries(table).items():
+            cursor.execute(sql.SQL("PREPARE {} AS {}").format(sql.Identifier(f"{table}_batch_{step}"), query))
+   connection.commit()
+   connection.info["batch_statements"] = True
+
+
+#Write a batch of rows (dicts with the table columns and their row_number) in its own transaction
+#The transaction is sent with its COMMIT in the same round trip, two round trips for employees as the rejected rows are read back first
+#Returns the number of rows written and the row_number of the employees whose foreign keys don't exist
+def write_batch(connection, records, table):
+   prepare_batch_statements(connection)
+   driver = connection.driver_connection
+   driver.autocommit = True
+   rejected = []
+   try:
+      with driver.cursor() as cursor, stage("batch", table):
+         begin = "BEGIN; SET LOCAL synchronous_commit TO %s; EXECUTE {}_batch_fill (%s)".format(table)
+         if table == "employee":
+            cursor.execute(begin + "; EXECUTE employee_batch_reject", [BATCH_SYNCHRONOUS_COMMIT, json.dumps(records)])
+            rejected = sorted(row[0] for row in cursor.fetchall())
+            cursor.execute("""EXECUTE employee_batch_lock_hires; EXECUTE employee_batch_previous_hires; EXECUTE employee_batch_empty_hires;
+                              EXECUTE employee_batch_new_hires; EXECUTE employee_batch_upsert; COMMIT""")
+         else:
+            cursor.execute(begin + f"; EXECUTE {table}_batch_upsert; COMMIT", [BATCH_SYNCHRONOUS_COMMIT, json.dumps(records)])
+   except Exception:
+      #A failed statement skips the rest of the round trip, COMMIT included, so the open transaction is rolled back here
+      with driver.cursor() as cursor:
+         cursor.execute("ROLLBACK")
+      raise
+   finally:
+      driver.autocommit = False
+   metrics.inc("ingest_rejected_rows_total", len(rejected), table=table)
+   #The upsert writes every staged row that wasn't rejected
+   return len(records) - len(rejected), rejected
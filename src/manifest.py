@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+
+#Block read at a time when a file is hashed
+HASH_BLOCK_SIZE = 1 << 20
+
+#Sources of the files on the manifest. The historical files replace every table, the new files are upserted on top of them
+HISTORICAL = "historical"
+NEW = "new"
+
+
+#SHA-256 of the content of a file, read in blocks so big files are never fully loaded in memory
+def file_hash(path):
+   digest = hashlib.sha256()
+   with open(path, "rb") as file:
+      for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+         digest.update(block)
+   return digest.hexdigest()
+
+
+#Size, modification time and SHA-256 of a file. It is only hashed again when its size or mtime differ from the recorded ones
+def file_state(path, recorded=None):
+   stat = os.stat(path)
+   state = {"size": stat.st_size, "mtime": stat.st_mtime}
+   if recorded is not None and (recorded["size"], recorded["mtime"]) == (state["size"], state["mtime"]):
+      state["sha256"] = recorded["sha256"]
+   else:
+      state["sha256"] = file_hash(path)
+   return state
+
+
+#Files of a source recorded on the ingest_manifest table, by absolute path
+def recorded_files(cursor, source):
+   cursor.execute("SELECT path, size, mtime, sha256, rejected FROM ingest_manifest WHERE source = %s", (source,))
+   return {path: {"size": size, "mtime": mtime, "sha256": sha256, "rejected": rejected} for path, size, mtime, sha256, rejected in cursor.fetchall()}
+
+
+#Whether a file of data/New was already loaded with the same content. Files with rejected rows are always loaded again,
+#as their departments or jobs may exist now
+def is_unchanged(state, recorded):
+   return recorded is not None and recorded["sha256"] == state["sha256"] and recorded["rejected"] == 0
+
+
+def record_file(cursor, source, path, state, rejected):
+   cursor.execute("""INSERT INTO ingest_manifest (path, source, size, mtime, sha256, rejected, loaded_at) VALUES (%s, %s, %s, %s, %s, %s, now())
+                     ON CONFLICT (path) DO UPDATE SET source = EXCLUDED.source, size = EXCLUDED.size, mtime = EXCLUDED.mtime, sha256 = EXCLUDED.sha256,
+                                                      rejected = EXCLUDED.rejected, loaded_at = now()""",
+                  (os.path.abspath(path), source, state["size"], state["mtime"], state["sha256"], rejected))
+
+
+#Forget the files of a source, or every file when source is None
+def forget_files(cursor, source=None):
+   if source is None:
+      cursor.execute("DELETE FROM ingest_manifest")
+   else:
+      cursor.execute("DELETE FROM ingest_manifest WHERE source = %s", (source,))
+
+
+#State of the historical files (a path per table) and whether they are the files of the latest historical load
+#The historical files are forgotten as soon as other data is written, so unchanged files mean the tables still hold exactly their data
+def historical_changes(cursor, paths):
+   recorded = recorded_files(cursor, HISTORICAL)
+   states = {table: file_state(path, recorded.get(os.path.abspath(path))) for table, path in paths.items()}
+   unchanged = set(recorded) == {os.path.abspath(path) for path in paths.values()} and \
+               all(recorded[os.path.abspath(path)]["sha256"] == states[table]["sha256"] for table, path in paths.items())
+   return states, unchanged
+
+
+#Record the files of a historical load on its transaction. The load replaced every table, so the files of data/New recorded before are forgotten too
+def record_historical(cursor, paths, states, rejected):
+   forget_files(cursor)
+   for table, path in paths.items():
+      record_file(cursor, HISTORICAL, path, states[table], rejected if table == "employee" else 0)
+
+
+#Record a file of data/New once all of its rows were written
+def save_file(connection, path, state, rejected):
+   with connection.cursor() as cursor:
+      record_file(cursor, NEW, path, state, rejected)
+   connection.commit()
+
+
+#Forget the historical load before data/New or the batch API change the tables, so the next historical load writes them again
+def forget_historical(connection):
+   with connection.cursor() as cursor:
+      forget_files(cursor, HISTORICAL)
+   connection.commit()
@@ -0,0 +1,214 @@
+from flask import g, request
+from bisect import bisect_left
+from contextlib import contextmanager
+import cProfile
+import logging
+import os
+import threading
+import time
+import psycopg2.extensions
+
+
+#Statements slower than this are logged with their SQL
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 500))
+
+#Requests sent with the X-Profile: 1 header are run under cProfile when PROFILE_REQUESTS is true, their stats are written to PROFILE_DIR
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "false").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/api-profiles")
+
+#Upper bounds in seconds of the buckets of every histogram
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+#Type and description of every metric, in the order they are exposed
+DEFINITIONS = {
+   "http_requests_total": ("counter", "Requests answered by end-point, method and status"),
+   "http_request_duration_seconds": ("histogram", "Time until the end-point returned its response, streamed bodies are sent after it"),
+   "ingest_stage_duration_seconds": ("histogram", "Time spent on each stage of the ingestion end-points and jobs"),
+   "ingest_rows_total": ("counter", "Rows read by the ingestion end-points and jobs"),
+   "ingest_rejected_rows_total": ("counter", "Employees left out because their department or job doesn't exist"),
+   "ingest_unchanged_rows_total": ("counter", "Rows of data/New skipped because they are already stored with the same values"),
+   "db_queries_total": ("counter", "Statements run on PostgreSQL by first keyword"),
+   "db_query_duration_seconds": ("histogram", "Time of the statements run on PostgreSQL by first keyword"),
+   "db_slow_queries_total": ("counter", "Statements slower than SLOW_QUERY_MS"),
+}
+
+logger = logging.getLogger("api")
+
+
+def escape(value):
+   return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+   return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}" if labels else ""
+
+
+#Counters and histograms of this process. Requests and jobs run in different threads, so every update holds a lock
+class Metrics:
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.counters = {}
+      self.histograms = {}
+
+   def inc(self, name, value=1, **labels):
+      key = (name, tuple(sorted(labels.items())))
+      with self.lock:
+         self.counters[key] = self.counters.get(key, 0) + value
+
+   def observe(self, name, value, **labels):
+      key = (name, tuple(sorted(labels.items())))
+      with self.lock:
+         histogram = self.histograms.get(key)
+         if histogram is None:
+            histogram = self.histograms[key] = {"buckets": [0] * (len(BUCKETS) + 1), "sum": 0.0, "count": 0}
+         histogram["buckets"][bisect_left(BUCKETS, value)] += 1
+         histogram["sum"] += value
+         histogram["count"] += 1
+
+   def value(self, name, **labels):
+      with self.lock:
+         return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+   #Sum of a counter over all its labels
+   def total(self, name):
+      with self.lock:
+         return sum(value for (metric, labels), value in self.counters.items() if metric == name)
+
+   #Prometheus text format. gauges holds (name, description, value) of values read when the metrics are scraped
+   def render(self, gauges=()):
+      with self.lock:
+         counters = dict(self.counters)
+         histograms = {key: {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]} for key, value in self.histograms.items()}
+      lines = []
+      for name, (kind, description) in DEFINITIONS.items():
+         lines.append(f"# HELP {name} {description}")
+         lines.append(f"# TYPE {name} {kind}")
+         if kind == "counter":
+            lines.extend(f"{name}{format_labels(labels)} {value}" for (metric, labels), value in sorted(counters.items()) if metric == name)
+            continue
+         for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+               continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram["buckets"]):
+               cumulative += count
+               lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+      for name, description, value in gauges:
+         lines.append(f"# HELP {name} {description}")
+         lines.append(f"# TYPE {name} gauge")
+         lines.append(f"{name} {value}")
+      return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+#Time a stage of an ingestion, such as the COPY of a table or the update of hire_summary
+@contextmanager
+def stage(name, table):
+   start = time.perf_counter()
+   try:
+      yield
+   finally:
+      metrics.observe("ingest_stage_duration_seconds", time.perf_counter() - start, stage=name, table=table)
+
+
+#Time every item taken from an iterator, used for the chunks of read_csv
+def timed_chunks(chunks, table, name="read_csv"):
+   iterator = iter(chunks)
+   while True:
+      with stage(name, table):
+         chunk = next(iterator, None)
+      if chunk is None:
+         return
+      yield chunk
+
+
+def record_query(cursor, query, seconds):
+   text = query.as_string(cursor) if hasattr(query, "as_string") else query.decode() if isinstance(query, bytes) else query
+   words = text.split(None, 1)
+   operation = words[0].rstrip(";").upper() if words else ""
+   metrics.inc("db_queries_total", operation=operation)
+   metrics.observe("db_query_duration_seconds", seconds, operation=operation)
+   if seconds * 1000 >= SLOW_QUERY_MS:
+      metrics.inc("db_slow_queries_total", operation=operation)
+      logger.warning("Slow query (%.1f ms): %s", seconds * 1000, " ".join(text.split())[:2000])
+
+
+#Cursor of every connection of the pool (see engine_options), it times the statements sent by the end-points and by SQLAlchemy
+class TimedCursor(psycopg2.extensions.cursor):
+   def execute(self, query, vars=None):
+      start = time.perf_counter()
+      try:
+         return super().execute(query, vars)
+      finally:
+         record_query(self, query, time.perf_counter() - start)
+
+   def executemany(self, query, vars_list):
+      start = time.perf_counter()
+      try:
+         return super().executemany(query, vars_list)
+      finally:
+         record_query(self, query, time.perf_counter() - start)
+
+   def copy_expert(self, sql, file, size=8192):
+      start = time.perf_counter()
+      try:
+         return super().copy_expert(sql, file, size)
+      finally:
+         record_query(self, sql, time.perf_counter() - start)
+
+
+#Run the rest of a streamed response under the profiler, and write the stats once the last chunk was sent
+def profiled(chunks, profiler, path):
+   iterator = iter(chunks)
+   try:
+      while True:
+         profiler.enable()
+         try:
+            chunk = next(iterator, None)
+         finally:
+            profiler.disable()
+         if chunk is None:
+            break
+         yield chunk
+   finally:
+      close = getattr(chunks, "close", None)
+      if close is not None:
+         close()
+      profiler.dump_stats(path)
+
+
+def start_request():
+   g.request_start = time.perf_counter()
+   if PROFILE_REQUESTS and request.headers.get("X-Profile") == "1":
+      g.profiler = cProfile.Profile()
+      g.profiler.enable()
+
+
+def finish_request(response):
+   endpoint = request.endpoint or "unmatched"
+   metrics.inc("http_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+   if "request_start" in g:
+      metrics.observe("http_request_duration_seconds", time.perf_counter() - g.request_start, endpoint=endpoint, method=request.method)
+
+   profiler = g.pop("profiler", None)
+   if profiler is not None:
+      profiler.disable()
+      os.makedirs(PROFILE_DIR, exist_ok=True)
+      path = os.path.join(PROFILE_DIR, f"{endpoint}-{time.time_ns()}-{os.getpid()}.prof")
+      #Streamed bodies are produced after the end-point returns, they are profiled while they are sent
+      if response.is_streamed:
+         response.response = profiled(response.response, profiler, path)
+      else:
+         profiler.dump_stats(path)
+      response.headers["X-Profile-File"] = path
+   return response
+
+
+#Time every request of an app and profile the ones that ask for it
+def instrument(app):
+   app.before_request(start_request)
+   app.after_request(finish_request)
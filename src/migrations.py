@@ -0,0 +1,75 @@
+#Schema changes applied on top of db.create_all(). Each migration runs once, in order, and is recorded on the schema_migrations table
+#Tables created from scratch by db.create_all() already have the final schema, so every migration must be safe to run on them
+MIGRATIONS = [
+   #The old datetime column was a VARCHAR(20) that accepted any text. Values that aren't a datetime are copied with their employee_id
+   #to the employee_invalid_hired_at table and converted to NULL, instead of failing the whole migration
+   ("001_employee_hired_at", """
+      CREATE OR REPLACE FUNCTION pg_temp.to_timestamptz_or_null(value TEXT) RETURNS TIMESTAMPTZ AS $$
+      BEGIN
+         RETURN NULLIF(value, '')::TIMESTAMPTZ;
+      EXCEPTION WHEN invalid_datetime_format OR datetime_field_overflow OR invalid_parameter_value THEN
+         RETURN NULL;
+      END $$ LANGUAGE plpgsql;
+      DO $$
+      BEGIN
+         IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'employee' AND column_name = 'datetime') THEN
+            CREATE TABLE IF NOT EXISTS employee_invalid_hired_at (employee_id INTEGER PRIMARY KEY, hired_at VARCHAR(20));
+            INSERT INTO employee_invalid_hired_at (employee_id, hired_at)
+            SELECT employee_id, datetime FROM employee WHERE datetime <> '' AND pg_temp.to_timestamptz_or_null(datetime) IS NULL
+            ON CONFLICT (employee_id) DO UPDATE SET hired_at = EXCLUDED.hired_at;
+            ALTER TABLE employee RENAME COLUMN datetime TO hired_at;
+            ALTER TABLE employee ALTER COLUMN hired_at TYPE TIMESTAMPTZ USING pg_temp.to_timestamptz_or_null(hired_at);
+         END IF;
+      END $$;
+      CREATE INDEX IF NOT EXISTS ix_employee_hired_at ON employee (hired_at);
+      CREATE INDEX IF NOT EXISTS ix_employee_department_id_hired_at ON employee (department_id, hired_at);
+      CREATE INDEX IF NOT EXISTS ix_employee_job_id_hired_at ON employee (job_id, hired_at);
+   """),
+   #The hire_summary table itself is created by db.create_all(), this counts the employees loaded before it existed
+   ("002_hire_summary", """
+      TRUNCATE TABLE hire_summary;
+      INSERT INTO hire_summary (year, quarter, department_id, job_id, hires)
+      SELECT EXTRACT(YEAR FROM hired_at AT TIME ZONE 'UTC')::INT, EXTRACT(QUARTER FROM hired_at AT TIME ZONE 'UTC')::INT, department_id, job_id, COUNT(*)
+      FROM employee GROUP BY 1, 2, 3, 4;
+   """),
+   #The SQL end-points read hire_summary, so no query uses the hire datetime indexes of 001 and they only slow down every write into employee
+   ("003_drop_employee_hired_at_indexes", """
+      DROP INDEX IF EXISTS ix_employee_hired_at;
+      DROP INDEX IF EXISTS ix_employee_department_id_hired_at;
+      DROP INDEX IF EXISTS ix_employee_job_id_hired_at;
+   """),
+   #Owner of every job, so the jobs left unfinished by a process that stopped can be marked as failed
+   ("004_ingest_job_owner", """
+      ALTER TABLE ingest_job ADD COLUMN IF NOT EXISTS owner_host VARCHAR(255), ADD COLUMN IF NOT EXISTS owner_pid INTEGER;
+   """),
+]
+
+
+#Apply the migrations that aren't recorded yet, each one in its own transaction
+def run_migrations(connection):
+   with connection.cursor() as cursor:
+      cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version VARCHAR(100) PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())")
+      cursor.execute("SELECT version FROM schema_migrations")
+      applied = {row[0] for row in cursor.fetchall()}
+   connection.commit()
+
+   for version, query in MIGRATIONS:
+      if version in applied:
+         continue
+      with connection.cursor() as cursor:
+         #Lock the table so several workers starting at the same time don't apply the same migration twice
+         cursor.execute("LOCK TABLE schema_migrations IN EXCLUSIVE MODE")
+         cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+         if cursor.fetchone() is None:
+            cursor.execute(query)
+            cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+      connection.commit()
+
+
+#Migrations not recorded yet on the schema_migrations table, used by the readiness check
+def pending_migrations(connection):
+   with connection.cursor() as cursor:
+      cursor.execute("SELECT version FROM schema_migrations")
+      applied = {row[0] for row in cursor.fetchall()}
+   connection.commit()
+   return [version for version, query in MIGRATIONS if version not in applied]
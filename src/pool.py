@@ -0,0 +1,60 @@
+from metrics import TimedCursor
+import os
+import threading
+import time
+
+
+#Settings of the connection pool shared by every end-point, they can be changed with environment variables
+def engine_options():
+   return {
+      "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+      "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+      "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", 30)),
+      "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+      "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+      #Every cursor of the pool times its statements and logs the slow ones
+      "connect_args": {"cursor_factory": TimedCursor},
+   }
+
+
+#Time spent by the requests waiting for a connection from the pool. Requests run in different threads, so every update holds a lock
+class PoolMetrics:
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.checkouts = 0
+      self.wait_total = 0.0
+      self.wait_max = 0.0
+
+   def record(self, wait):
+      with self.lock:
+         self.checkouts += 1
+         self.wait_total += wait
+         self.wait_max = max(self.wait_max, wait)
+
+   def snapshot(self, engine):
+      pool = engine.pool
+      #The engine is created with engine_options, so the overflow is read from them instead of the pool's private attribute
+      maxOverflow = engine_options()["max_overflow"]
+      capacity = pool.size() + max(maxOverflow, 0)
+      with self.lock:
+         return {
+            "pool_size": pool.size(),
+            "max_overflow": maxOverflow,
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "utilization": round(pool.checkedout() / capacity, 4) if capacity else 0,
+            "checkouts": self.checkouts,
+            "checkout_wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0,
+            "checkout_wait_max_ms": round(self.wait_max * 1000, 3),
+         }
+
+
+pool_metrics = PoolMetrics()
+
+
+#Take a raw psycopg2 connection from the shared pool, recording how long the request waited for it. Closing it returns it to the pool
+def checkout(engine):
+   start = time.perf_counter()
+   connection = engine.raw_connection()
+   pool_metrics.record(time.perf_counter() - start)
+   return connection
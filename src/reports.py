@@ -0,0 +1,102 @@
+from flask import Response, request
+import csv
+import io
+import json
+import pyarrow as pa
+
+#Rows fetched from the server-side cursor and rendered at a time
+FETCH_SIZE = 2000
+
+#Media types of the formats the SQL end-points can answer with, the first one is the default
+FORMATS = {
+   "html": "text/html",
+   "json": "application/x-ndjson",
+   "csv": "text/csv",
+   "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+#Pick the output format from ?format= or else from the Accept header. HTML is kept as the default for browsers
+def negotiate_format():
+   requested = request.args.get("format")
+   if requested is not None:
+      return requested if requested in FORMATS else None
+   best = request.accept_mimetypes.best_match(list(FORMATS.values()), default=FORMATS["html"])
+   return next(name for name, mimetype in FORMATS.items() if mimetype == best)
+
+
+#HTML table, with the same markup the end-points have always returned
+def render_html(columns, labels, types, batches):
+   yield "<table border='1'><tr>" + "".join(f"<th>{label}</th>" for label in labels) + "</tr>"
+   for batch in batches:
+      yield "".join("<tr>" + "".join(f"<td>{value}</td>" for value in row) + "</tr>" for row in batch)
+   yield "</table>"
+
+
+#One JSON object per line
+def render_json(columns, labels, types, batches):
+   for batch in batches:
+      yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in batch)
+
+
+#CSV with a header line
+def render_csv(columns, labels, types, batches):
+   buffer = io.StringIO()
+   writer = csv.writer(buffer, lineterminator="\n")
+   writer.writerow(columns)
+   for batch in batches:
+      writer.writerows(batch)
+      yield buffer.getvalue()
+      buffer.seek(0)
+      buffer.truncate()
+   yield buffer.getvalue()
+
+
+#Arrow IPC stream, one record batch per fetched batch. The schema is built from the Arrow type names of the columns,
+#so it doesn't depend on the values of any batch, such as a column that is all NULL on the first one
+def render_arrow(columns, labels, types, batches):
+   schema = pa.schema([(column, pa.type_for_alias(type)) for column, type in zip(columns, types)])
+   sink = io.BytesIO()
+   writer = pa.ipc.new_stream(sink, schema)
+   for batch in batches:
+      writer.write_table(pa.Table.from_pylist([dict(zip(columns, row)) for row in batch], schema=schema))
+      yield sink.getvalue()
+      sink.seek(0)
+      sink.truncate()
+   writer.close()
+   yield sink.getvalue()
+
+
+RENDERERS = {"html": render_html, "json": render_json, "csv": render_csv, "arrow": render_arrow}
+
+
+#Run a query on a named (server-side) cursor and yield its rows in batches, so only FETCH_SIZE rows are held in memory at a time
+#The connection is taken when the first row is needed and returned to the pool when the last row is sent or when the client goes away
+def fetch_batches(connect, query, params):
+   connection = connect()
+   try:
+      with connection.cursor(name="report") as cursor:
+         cursor.itersize = FETCH_SIZE
+         cursor.execute(query, params)
+         while True:
+            batch = cursor.fetchmany(FETCH_SIZE)
+            if not batch:
+               break
+            yield batch
+      connection.commit()
+   finally:
+      connection.close()
+
+
+#Stream the result of a report query in the format asked by the client
+#columns name the fields of the JSON, CSV and Arrow formats, labels are the headers of the HTML table and types the Arrow types of the columns
+#The rows are sent after the request context is gone, so connect must not depend on it
+def report_response(connect, query, params, columns, labels, types):
+   format = negotiate_format()
+   if format is None:
+      return Response(f"<p>ERROR: Unknown format. Use one of {', '.join(FORMATS)} - 406</p>", status=406, mimetype="text/html")
+
+   batches = fetch_batches(connect, query, params)
+   response = Response(RENDERERS[format](columns, labels, types, batches), mimetype=FORMATS[format])
+   response.vary.add("Accept")
+   return response
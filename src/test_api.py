@@ -1,13 +1,35 @@
-from api import api, db, DepartmentSchema, JobSchema, EmployeeSchema
+from api import create_app, setup_database, db, DepartmentSchema, JobSchema, EmployeeSchema
+from loader import format_rejected_rows, RejectedRows, split_csv, frame_to_csv, matches_schema, READ_DTYPES
+from cache import LocalCacheBackend
+import reports
+from jobs import jobs, HOSTNAME
+from migrations import MIGRATIONS
+from metrics import metrics
+import metrics as metrics_module
+import pstats
 import pytest
 from unittest.mock import patch
 import pandas as pd
+import pyarrow as pa
+import json
+import time
+import io
+import csv
+import sys
+import os
+import subprocess
+import logging
 
+api = create_app()
 api.config['TESTING'] = True
 
 @pytest.fixture
 def client():
     api.config['TESTING'] = True
+    #Every test starts with an empty manifest, so its first upload loads the CSV files
+    with api.app_context():
+        db.session.execute(db.text("DELETE FROM ingest_manifest"))
+        db.session.commit()
     with api.test_client() as client:
         yield client
 
@@ -37,3 +59,554 @@ def test_upload_historical_data_files_exist_empty(mock_getsize, mock_exists, cli
 
     assert resp.status_code == 200
     assert "ERROR: Job CSV or Department CSV are empty. No data was uploaded - 500" in resp.data.decode()
+
+def test_upload_historical_data_loads_all_tables(client):
+
+    resp = client.post('/api/v1/upload_historical_data')
+
+    assert resp.status_code == 200
+    assert "Data uploaded to Employee table successfully! - 200" in resp.data.decode()
+    with api.app_context():
+        assert db.session.query(DepartmentSchema).count() == len(pd.read_csv("data/Historical/departments.csv", header=None))
+        assert db.session.query(EmployeeSchema).count() == len(pd.read_csv("data/Historical/hired_employees.csv", header=None))
+
+def test_upload_historical_data_invalid_foreign_keys(client, tmp_path, monkeypatch):
+
+    (tmp_path / "data" / "Historical").mkdir(parents=True)
+    (tmp_path / "data" / "Historical" / "departments.csv").write_text("1,Sales\n")
+    (tmp_path / "data" / "Historical" / "jobs.csv").write_text("1,VP Sales\n")
+    (tmp_path / "data" / "Historical" / "hired_employees.csv").write_text("1,Ana,2021-01-01T00:00:00Z,1,1\n2,Luis,2021-02-01T00:00:00Z,7,1\n")
+    monkeypatch.chdir(tmp_path)
+
+    resp = client.post('/api/v1/upload_historical_data')
+
+    assert "Data uploaded to Job table successfully! - 200" in resp.data.decode()
+    assert "Department ID or Job ID not valid on CSV rows 2." in resp.data.decode()
+    assert "The other 1 rows were uploaded" in resp.data.decode()
+    with api.app_context():
+        assert db.session.get(EmployeeSchema, 1).name == "Ana"
+        assert db.session.get(EmployeeSchema, 2) is None
+
+def test_upload_historical_data_keeps_previous_data_when_departments_fail(client, tmp_path, monkeypatch):
+
+    client.post('/api/v1/upload_historical_data')
+    with api.app_context():
+        counts = (db.session.query(DepartmentSchema).count(), db.session.query(EmployeeSchema).count())
+
+    (tmp_path / "data" / "Historical").mkdir(parents=True)
+    (tmp_path / "data" / "Historical" / "departments.csv").write_text("one,Sales\n")
+    (tmp_path / "data" / "Historical" / "jobs.csv").write_text("1,VP Sales\n")
+    (tmp_path / "data" / "Historical" / "hired_employees.csv").write_text("1,Ana,2021-01-01T00:00:00Z,1,1\n")
+    monkeypatch.chdir(tmp_path)
+
+    resp = client.post('/api/v1/upload_historical_data')
+
+    assert "ERROR: Review the Department table Schema" in resp.data.decode()
+    assert "The historical load was rolled back. No data was changed - 500" in resp.data.decode()
+    with api.app_context():
+        assert (db.session.query(DepartmentSchema).count(), db.session.query(EmployeeSchema).count()) == counts
+
+def test_insert_data_reads_csv_in_chunks(client, tmp_path, monkeypatch):
+
+    client.post('/api/v1/upload_historical_data')
+    (tmp_path / "data" / "New").mkdir(parents=True)
+    (tmp_path / "data" / "New" / "hired_employees.csv").write_text("9001,Ana,2021-01-01T00:00:00Z,1,1\n9002,Luis,2021-02-01T00:00:00Z,2,\n9003,Eva,2021-03-01T00:00:00Z,,3\n9004,Juan,2021-04-01T00:00:00Z,999,3\n")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("api.CHUNK_SIZE", 2)
+
+    resp = client.post('/api/v1/insert_data')
+
+    assert "Department ID or Job ID not valid on CSV rows 4." in resp.data.decode()
+    assert "The other 3 rows were inserted" in resp.data.decode()
+    assert client.get('/api/v1/progress').json["employee"] == {"rows": 4, "chunks": 2, "done": True}
+    with api.app_context():
+        assert db.session.get(EmployeeSchema, 9002).job_id is None
+        assert db.session.get(EmployeeSchema, 9003).department_id is None
+        assert db.session.get(EmployeeSchema, 9004) is None
+
+def test_insert_data_reports_the_rows_of_a_failed_batch(client, tmp_path, monkeypatch):
+
+    client.post('/api/v1/upload_historical_data')
+    (tmp_path / "data" / "New").mkdir(parents=True)
+    (tmp_path / "data" / "New" / "hired_employees.csv").write_text(
+        "9001,Ana,2021-01-01T00:00:00Z,1,1\n9002,Luis,2021-02-01T00:00:00Z,2,2\n9003," + "E" * 60 + ",2021-03-01T00:00:00Z,3,3\n9004,Juan,2021-04-01T00:00:00Z,4,4\n9005,Rosa,2021-05-01T00:00:00Z,5,5\n")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("loader.BATCH_SIZE", 2)
+
+    resp = client.post('/api/v1/insert_data')
+
+    assert resp.status_code == 200
+    assert "ERROR: The Employee table couldn't be written on CSV rows 3 to 4" in resp.data.decode()
+    assert client.get('/api/v1/progress').json["employee"]["done"]
+    with api.app_context():
+        assert db.session.get(EmployeeSchema, 9002).name == "Luis"
+        assert db.session.get(EmployeeSchema, 9004) is None and db.session.get(EmployeeSchema, 9005) is None
+    #The file wasn't recorded, so it is read again
+    assert "ERROR: The Employee table couldn't be written on CSV rows 3 to 4" in client.post('/api/v1/insert_data').data.decode()
+
+def test_insert_data_upserts_existing_ids(client):
+
+    client.post('/api/v1/upload_historical_data')
+
+    resp = client.post('/api/v1/insert_data')
+
+    assert "New records inserted in Employee table!" in resp.data.decode()
+    with api.app_context():
+        assert db.session.get(DepartmentSchema, 1).department == "NEW Product Management"
+        assert db.session.get(EmployeeSchema, 1).name == "Carlos"
+        assert db.session.query(EmployeeSchema).count() == 2001
+
+def test_format_rejected_rows_limits_listed_rows():
+
+    assert format_rejected_rows([3, 8]) == "3, 8"
+    assert format_rejected_rows(list(range(1, 106))) == ", ".join(str(row) for row in range(1, 101)) + " and 5 more"
+
+    #Loads read in chunks keep only the first rows and count the rest
+    rejected = RejectedRows()
+    for chunk in range(0, 1000, 10):
+        rejected.extend(list(range(chunk + 1, chunk + 11)))
+    assert rejected.count == 1000 and rejected.rows == list(range(1, 101))
+    assert format_rejected_rows(rejected.rows, total=rejected.count) == ", ".join(str(row) for row in range(1, 101)) + " and 900 more"
+
+def test_pool_usage_counts_checkouts(client):
+
+    client.post('/api/v1/insert_data')
+    before = client.get('/api/v1/pool').json["checkouts"]
+    client.get('/api/v1/number-of-employees').data
+    client.get('/api/v1/hired-per-department').data
+
+    usage = client.get('/api/v1/pool').json
+    assert usage["checkouts"] == before + 2
+    assert usage["checked_out"] == 0
+    assert (usage["pool_size"], usage["max_overflow"]) == (5, 10)
+
+def hire_summary_rows():
+    with api.app_context():
+        rows = db.session.execute(db.text("SELECT year, quarter, department_id, job_id, hires FROM hire_summary")).all()
+    return sorted(map(str, rows))
+
+def test_insert_data_updates_hire_summary_incrementally(client):
+
+    client.post('/api/v1/upload_historical_data')
+    client.post('/api/v1/insert_data')
+
+    incremental = hire_summary_rows()
+    with api.app_context():
+        db.session.execute(db.text("""TRUNCATE hire_summary;
+                                      INSERT INTO hire_summary (year, quarter, department_id, job_id, hires)
+                                      SELECT EXTRACT(YEAR FROM hired_at AT TIME ZONE 'UTC'), EXTRACT(QUARTER FROM hired_at AT TIME ZONE 'UTC'), department_id, job_id, COUNT(*)
+                                      FROM employee GROUP BY 1, 2, 3, 4"""))
+        db.session.commit()
+    assert incremental == hire_summary_rows()
+
+def test_number_of_employees_by_year(client):
+
+    client.post('/api/v1/upload_historical_data')
+    employees = pd.read_csv("data/Historical/hired_employees.csv", header=None)
+    hires2022 = employees[employees[2].str.startswith("2022", na=False)]
+
+    resp = client.get('/api/v1/number-of-employees?year=2022')
+
+    assert resp.data.decode().count("<tr>") == 1 + len(hires2022.groupby([3, 4], dropna=False))
+    assert client.get('/api/v1/number-of-employees?year=1999').data.decode().count("<tr>") == 1
+
+def test_hired_per_department_by_year(client):
+
+    client.post('/api/v1/upload_historical_data')
+    employees = pd.read_csv("data/Historical/hired_employees.csv", header=None)
+    hires2022 = employees[employees[2].str.startswith("2022", na=False)].groupby(3).size()
+    above = hires2022[hires2022 > hires2022.mean()].sort_values(ascending=False)
+
+    lines = client.get('/api/v1/hired-per-department?year=2022&format=json').data.decode().splitlines()
+
+    assert [(row["department_id"], row["hired"]) for row in map(json.loads, lines)] == [(int(department), hired) for department, hired in above.items()]
+    assert client.get('/api/v1/hired-per-department?year=1999&format=json').data == b""
+
+def test_reports_are_cached_until_data_changes(client):
+
+    client.post('/api/v1/upload_historical_data')
+    before = client.get('/api/v1/cache').json
+
+    first = client.get('/api/v1/hired-per-department')
+    assert first.is_streamed and "ETag" not in first.headers
+    first.data
+    second = client.get('/api/v1/hired-per-department')
+    unchanged = client.get('/api/v1/hired-per-department', headers={"If-None-Match": second.headers["ETag"]})
+    client.post('/api/v1/insert_data')
+    changed = client.get('/api/v1/hired-per-department', headers={"If-None-Match": second.headers["ETag"]})
+
+    after = client.get('/api/v1/cache').json
+    assert second.data == first.data
+    assert unchanged.status_code == 304 and unchanged.data == b""
+    assert changed.status_code == 200 and "NEW Support" in changed.data.decode()
+    assert after["hits"] - before["hits"] == 2
+    assert after["misses"] - before["misses"] == 2
+    assert after["data_version"] == before["data_version"] + 1
+
+def test_local_cache_backend_evicts_least_recently_used():
+
+    backend = LocalCacheBackend(max_entries=2)
+    backend.set("a", 1)
+    backend.set("b", 2)
+    backend.get("a")
+    backend.set("c", 3)
+
+    assert backend.get("b") is None
+    assert backend.get("a") == 1 and backend.get("c") == 3
+
+def test_reports_stream_requested_format(client):
+
+    client.post('/api/v1/upload_historical_data')
+
+    lines = client.get('/api/v1/hired-per-department?format=json').data.decode().splitlines()
+    table = client.get('/api/v1/hired-per-department', headers={"Accept": "text/csv"})
+    arrow = client.get('/api/v1/number-of-employees', headers={"Accept": "application/vnd.apache.arrow.stream"})
+    unknown = client.get('/api/v1/number-of-employees?format=xml')
+
+    assert json.loads(lines[0]) == {"department_id": 8, "department": "Support", "hired": 221}
+    assert table.mimetype == "text/csv"
+    assert table.data.decode().splitlines()[:2] == ["department_id,department,hired", "8,Support,221"]
+    report = pa.ipc.open_stream(arrow.data).read_all()
+    assert report.column_names == ["department", "job", "q1", "q2", "q3", "q4"]
+    assert sum(report.column("q1").to_pylist()) + sum(report.column("q4").to_pylist()) > 0
+    assert unknown.status_code == 406
+
+def test_reports_stream_arrow_in_several_batches(client, monkeypatch):
+
+    client.post('/api/v1/upload_historical_data')
+    monkeypatch.setattr(reports, "FETCH_SIZE", 1)
+
+    lines = client.get('/api/v1/number-of-employees?format=json').data.decode().splitlines()
+    stream = pa.ipc.open_stream(client.get('/api/v1/number-of-employees?format=arrow').data)
+    batches = list(stream)
+
+    assert len(batches) == len(lines) > 1
+    assert stream.schema.field("q1").type == pa.int64()
+    assert pa.Table.from_batches(batches).to_pylist() == [json.loads(line) for line in lines]
+
+def test_insert_batch_reads_csv_json_and_ndjson_bodies(client):
+
+    client.post('/api/v1/upload_historical_data')
+
+    departments = client.post('/api/v1/department/batch', data="100,Batch Sales\n101,Batch Support\n", content_type="text/csv")
+    jobs = client.post('/api/v1/job/batch', json=[{"job_id": 500, "job": "Batch Analyst"}])
+    employees = client.post('/api/v1/employee/batch?batch_size=2', content_type="application/x-ndjson",
+                            data="\n".join(json.dumps(row) for row in [
+                                {"employee_id": 1, "name": "Renamed", "hired_at": "2021-03-01T00:00:00Z", "department_id": 100, "job_id": 500},
+                                {"employee_id": 90001, "name": "Ana", "hired_at": "2021-05-01T00:00:00Z", "department_id": 100, "job_id": None},
+                                {"employee_id": 90002, "name": "Luis", "hired_at": "2021-06-01T00:00:00Z", "department_id": 999, "job_id": 500},
+                            ]))
+
+    assert departments.json["written"] == 2 and jobs.json["written"] == 1
+    report = employees.json
+    assert report["rows"] == 3 and report["written"] == 2 and report["rejected"] == 1 and report["rejected_rows"] == [3]
+    assert [batch["rows"] for batch in report["batches"]] == [2, 1]
+    assert all(batch["seconds"] > 0 and batch["rows_per_second"] > 0 for batch in report["batches"])
+    incremental = hire_summary_rows()
+    with api.app_context():
+        assert db.session.get(EmployeeSchema, 1).name == "Renamed"
+        db.session.execute(db.text("""TRUNCATE hire_summary;
+                                      INSERT INTO hire_summary (year, quarter, department_id, job_id, hires)
+                                      SELECT EXTRACT(YEAR FROM hired_at AT TIME ZONE 'UTC'), EXTRACT(QUARTER FROM hired_at AT TIME ZONE 'UTC'), department_id, job_id, COUNT(*)
+                                      FROM employee GROUP BY 1, 2, 3, 4"""))
+        db.session.commit()
+    assert incremental == hire_summary_rows()
+
+def test_insert_batch_rejects_invalid_requests(client):
+
+    assert client.post('/api/v1/salary/batch', json=[]).status_code == 404
+    assert client.post('/api/v1/job/batch?batch_size=1001', json=[]).status_code == 400
+    assert client.post('/api/v1/job/batch', data="<jobs/>", content_type="application/xml").status_code == 415
+    failed = client.post('/api/v1/job/batch?batch_size=1', data="600,Kept\nseven,Failed\n", content_type="text/csv")
+    assert failed.status_code == 400
+    assert failed.json["written"] == 1 and "invalid input syntax" in failed.json["error"]
+
+def wait_for_job(client, url):
+    for _ in range(600):
+        job = client.get(url).json
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError(url)
+
+def test_jobs_of_stopped_processes_are_marked_failed(client):
+
+    stopped = subprocess.Popen([sys.executable, "-c", "pass"])
+    stopped.wait()
+    with api.app_context():
+        for job_id, pid in (("stoppedworker", stopped.pid), ("runningworker", os.getpid())):
+            snapshot = {"id": job_id, "kind": "upload_historical_data", "status": "writing", "error": None, "submitted_at": "2021-01-01T00:00:00+00:00", "finished_at": None}
+            db.session.execute(db.text("""INSERT INTO ingest_job (job_id, kind, status, snapshot, submitted_at, updated_at, owner_host, owner_pid)
+                                          VALUES (:id, 'upload_historical_data', 'writing', :snapshot, now(), now(), :host, :pid)"""),
+                               {"id": job_id, "snapshot": json.dumps(snapshot), "host": HOSTNAME, "pid": pid})
+        db.session.commit()
+
+    try:
+        job = client.get('/api/v1/jobs/stoppedworker').json
+        assert job["status"] == "failed" and f"pid {stopped.pid}" in job["error"] and job["finished_at"] is not None
+        assert client.get('/api/v1/jobs/runningworker').json["status"] == "writing"
+    finally:
+        with api.app_context():
+            db.session.execute(db.text("DELETE FROM ingest_job WHERE job_id IN ('stoppedworker', 'runningworker')"))
+            db.session.commit()
+
+def test_historical_data_job_loads_tables_in_background(client):
+
+    resp = client.post('/api/v1/jobs/upload_historical_data')
+
+    assert resp.status_code == 202
+    job = wait_for_job(client, resp.headers["Location"])
+    assert job["status"] == "succeeded" and job["error"] is None
+    assert set(job["tables"]) == {"department", "job", "employee"}
+    assert job["tables"]["employee"]["rows"] == len(pd.read_csv("data/Historical/hired_employees.csv", header=None))
+    assert all(table["done"] and table["rows_per_second"] > 0 for table in job["tables"].values())
+    assert job["id"] in [listed["id"] for listed in client.get('/api/v1/jobs').json]
+    with api.app_context():
+        assert db.session.query(EmployeeSchema).count() == job["tables"]["employee"]["rows"] - job["rejected"]
+        assert db.session.execute(db.text("SELECT COUNT(*) FROM pg_tables WHERE tablename LIKE '%%_load_%%'")).scalar() == 0
+
+def test_historical_data_job_validates_before_truncating(client, tmp_path, monkeypatch):
+
+    client.post('/api/v1/upload_historical_data')
+    with api.app_context():
+        before = db.session.query(EmployeeSchema).count()
+    (tmp_path / "data" / "Historical").mkdir(parents=True)
+    (tmp_path / "data" / "Historical" / "departments.csv").write_text("1,Sales\n")
+    (tmp_path / "data" / "Historical" / "jobs.csv").write_text("one,VP Sales\n")
+    (tmp_path / "data" / "Historical" / "hired_employees.csv").write_text("1,Ana,2021-01-01T00:00:00Z,1,1\n")
+    monkeypatch.chdir(tmp_path)
+
+    job = wait_for_job(client, client.post('/api/v1/jobs/upload_historical_data').headers["Location"])
+
+    assert job["status"] == "failed" and "No data was changed" in job["error"]
+    assert "invalid input syntax" in job["tables"]["job"]["error"]
+    assert job["tables"]["department"]["done"] and "error" not in job["tables"]["department"]
+    assert client.get('/api/v1/jobs/unknown').status_code == 404
+    with api.app_context():
+        assert db.session.query(EmployeeSchema).count() == before
+
+def test_historical_data_job_copies_shards_in_parallel(client, tmp_path, monkeypatch):
+
+    (tmp_path / "data" / "Historical").mkdir(parents=True)
+    (tmp_path / "data" / "Historical" / "departments.csv").write_text("1,Sales\n2,Support\n")
+    (tmp_path / "data" / "Historical" / "jobs.csv").write_text("1,VP Sales\n")
+    lines = [f"{i},Employee {i},2021-0{i % 9 + 1}-01T00:00:00Z,{999 if i in (3, 17, 38) else i % 2 + 1},1" for i in range(1, 41)]
+    (tmp_path / "data" / "Historical" / "hired_employees.csv").write_text("\n".join(lines))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("loader.COPY_SHARDS", 4)
+    monkeypatch.setattr("loader.SHARD_MIN_BYTES", 200)
+
+    ranges = split_csv("data/Historical/hired_employees.csv", 4)
+    job = wait_for_job(client, client.post('/api/v1/jobs/upload_historical_data').headers["Location"])
+
+    content = (tmp_path / "data" / "Historical" / "hired_employees.csv").read_bytes()
+    assert len(ranges) == 4 and b"".join(content[start:end] for start, end in ranges) == content
+    assert all(content[end - 1:end] == b"\n" for start, end in ranges[:-1])
+    assert job["status"] == "succeeded"
+    assert job["rejected_rows"] == [3, 17, 38]
+    assert job["tables"]["employee"]["rows"] == 40
+    with api.app_context():
+        assert db.session.query(EmployeeSchema).count() == 37
+        assert db.session.execute(db.text("SELECT COUNT(*) FROM pg_tables WHERE tablename LIKE '%%_load_%%'")).scalar() == 0
+
+def test_frame_to_csv_writes_nullable_ids_with_and_without_pyarrow(monkeypatch):
+
+    frame = pd.read_csv(io.StringIO("7,\"Ana, Jr\",2021-01-01T00:00:00Z,1,\n8,Luis,2021-02-01T00:00:00Z,,3\n"),
+                        names=["employee_id", "name", "hired_at", "department_id", "job_id"], dtype=READ_DTYPES["employee"])
+    arrow = frame_to_csv(frame, "employee").read()
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    fallback = frame_to_csv(frame, "employee").read()
+
+    assert matches_schema(frame, "employee")
+    for encoded in (arrow, fallback):
+        rows = list(csv.reader(io.StringIO(encoded.decode())))
+        assert rows == [["1", "7", "Ana, Jr", "2021-01-01T00:00:00Z", "1", ""], ["2", "8", "Luis", "2021-02-01T00:00:00Z", "", "3"]]
+
+def test_insert_data_restores_rows_rewritten_by_the_batch_api(client, tmp_path, monkeypatch):
+
+    client.post('/api/v1/upload_historical_data')
+    (tmp_path / "data" / "New").mkdir(parents=True)
+    (tmp_path / "data" / "New" / "hired_employees.csv").write_text("9001,Ana,2021-01-01T00:00:00Z,1,1\n9002,Luis,2021-02-01T00:00:00Z,2,2\n")
+    monkeypatch.chdir(tmp_path)
+    client.post('/api/v1/insert_data')
+    summary = hire_summary_rows()
+
+    resp = client.post('/api/v1/employee/batch', content_type="application/x-ndjson",
+                       data='{"employee_id": 9001, "name": "Rewritten", "hired_at": "2022-06-01T00:00:00Z", "department_id": 2, "job_id": 2}\n')
+    assert resp.status_code == 200
+
+    #The file didn't change, but the batch overwrote one of its rows, so the replay must write it again
+    client.post('/api/v1/insert_data')
+    with api.app_context():
+        employee = db.session.get(EmployeeSchema, 9001)
+        assert (employee.name, employee.hired_at.year, employee.department_id) == ("Ana", 2021, 1)
+    assert hire_summary_rows() == summary
+
+def test_chunks_with_empty_text_columns_match_schema():
+
+    employees = pd.read_csv(io.StringIO("7,,,1,2\n8,,,,\n"), names=["employee_id", "name", "hired_at", "department_id", "job_id"], dtype=READ_DTYPES["employee"])
+    departments = pd.read_csv(io.StringIO("1,\n2,\n"), names=["department_id", "department"], dtype=READ_DTYPES["department"])
+    jobs = pd.read_csv(io.StringIO("1,\n"), names=["job_id", "job"], dtype=READ_DTYPES["job"])
+
+    assert matches_schema(employees, "employee")
+    assert matches_schema(departments, "department")
+    assert matches_schema(jobs, "job")
+
+def test_hired_at_migration_keeps_unparseable_legacy_values(client):
+
+    with api.app_context():
+        connection = db.engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            #A table of an older version, on its own schema so the tables of the other tests are not touched
+            cursor.execute("CREATE SCHEMA legacy; SET LOCAL search_path TO legacy")
+            cursor.execute("CREATE TABLE employee (employee_id INTEGER PRIMARY KEY, name VARCHAR(50), datetime VARCHAR(20), department_id INTEGER, job_id INTEGER)")
+            cursor.execute("INSERT INTO employee VALUES (1, 'Ana', '2021-01-01T00:00:00Z', 1, 1), (2, 'Luis', 'not a date', 1, 1), (3, 'Eva', '', 1, 1)")
+            cursor.execute(dict(MIGRATIONS)["001_employee_hired_at"])
+            cursor.execute("SELECT employee_id, hired_at IS NULL FROM employee ORDER BY employee_id")
+            converted = cursor.fetchall()
+            cursor.execute("SELECT employee_id, hired_at FROM employee_invalid_hired_at")
+            invalid = cursor.fetchall()
+    finally:
+        connection.rollback()
+        connection.close()
+
+    assert converted == [(1, False), (2, True), (3, True)]
+    assert invalid == [(2, "not a date")]
+
+def test_setup_database_prints_the_error_of_a_failed_migration(monkeypatch, capsys):
+
+    def failing_migrations(connection):
+        raise ValueError("invalid input syntax for type timestamp with time zone")
+    monkeypatch.setattr("api.run_migrations", failing_migrations)
+
+    with pytest.raises(SystemExit):
+        setup_database(api)
+
+    output = capsys.readouterr()
+    assert "The tables couldn't be created or migrated" in output.out and "Username or password" not in output.out
+    assert "invalid input syntax for type timestamp with time zone" in output.err
+
+def test_employee_has_no_hire_datetime_indexes(client):
+
+    with api.app_context():
+        indexes = db.session.execute(db.text("SELECT indexname FROM pg_indexes WHERE tablename = 'employee'")).scalars().all()
+    assert indexes == ["employee_pkey"]
+
+def test_health_and_readiness(client):
+
+    assert client.get('/healthz').json == {"status": "ok"}
+    assert client.get('/readyz').json == {"status": "ready"}
+
+def test_job_status_is_read_from_other_processes(client):
+
+    resp = client.post('/api/v1/jobs/upload_historical_data')
+    job = wait_for_job(client, resp.headers["Location"])
+    #Forget the job on this process, as if the status was asked to another worker
+    del jobs.jobs[job["id"]]
+
+    saved = client.get(resp.headers["Location"]).json
+    assert saved["status"] == "succeeded" and saved["tables"]["employee"]["rows"] == job["tables"]["employee"]["rows"]
+    assert job["id"] in [listed["id"] for listed in client.get('/api/v1/jobs').json]
+
+def test_local_cache_backend_shares_data_version_with_forked_workers():
+
+    backend = LocalCacheBackend()
+    pid = os.fork()
+    if pid == 0:
+        backend.bump_version()
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert backend.version() == 1
+
+def test_metrics_expose_requests_stages_and_queries(client):
+
+    queries = metrics.value("db_queries_total", operation="SELECT")
+    client.post('/api/v1/upload_historical_data')
+    client.get('/api/v1/hired-per-department?format=csv&year=2021')
+
+    assert metrics.value("db_queries_total", operation="SELECT") > queries
+    resp = client.get('/metrics')
+    assert resp.status_code == 200 and resp.mimetype == "text/plain"
+    text = resp.data.decode()
+    assert "# TYPE http_request_duration_seconds histogram" in text
+    assert 'http_requests_total{endpoint="api.upload_historical_data",method="POST",status="200"}' in text
+    assert 'http_request_duration_seconds_bucket{endpoint="api.hired_per_department",method="GET",le="+Inf"}' in text
+    for stage in ("copy", "validate", "insert"):
+        assert f'ingest_stage_duration_seconds_count{{stage="{stage}",table="employee"}}' in text
+    assert 'ingest_rows_total{table="employee"}' in text
+    assert 'db_query_duration_seconds_count{operation="COPY"}' in text
+    assert "db_pool_checked_out " in text
+
+def test_slow_queries_are_logged(client, monkeypatch, caplog):
+
+    monkeypatch.setattr(metrics_module, "SLOW_QUERY_MS", 0)
+    with caplog.at_level(logging.WARNING, logger="api"):
+        client.get('/api/v1/number-of-employees?format=json&year=1990')
+
+    assert any("Slow query" in record.message and "hire_summary" in record.message for record in caplog.records)
+
+def test_requests_are_profiled_on_demand(client, tmp_path, monkeypatch):
+
+    monkeypatch.setattr(metrics_module, "PROFILE_REQUESTS", True)
+    monkeypatch.setattr(metrics_module, "PROFILE_DIR", str(tmp_path))
+
+    assert "X-Profile-File" not in client.get('/api/v1/hired-per-department?format=csv&year=1991').headers
+    resp = client.get('/api/v1/hired-per-department?format=csv&year=1992', headers={"X-Profile": "1"})
+    resp.get_data()
+    resp.close()
+
+    stats = pstats.Stats(resp.headers["X-Profile-File"])
+    assert any(function == "fetch_batches" for _, _, function in stats.stats)
+
+def employee_version(employee_id):
+    with api.app_context():
+        return db.session.execute(db.text("SELECT xmin::text FROM employee WHERE employee_id = :id"), {"id": employee_id}).scalar()
+
+def test_upload_historical_data_skips_unchanged_files(client):
+
+    client.post('/api/v1/upload_historical_data')
+    version = employee_version(1)
+
+    skipped = client.post('/api/v1/upload_historical_data')
+    assert "Historical CSV files didn't change since the last upload" in skipped.data.decode()
+    assert employee_version(1) == version
+    job = wait_for_job(client, client.post('/api/v1/jobs/upload_historical_data').headers["Location"])
+    assert job["status"] == "succeeded" and job["unchanged"] and job["tables"] == {}
+
+    #Data written by insert_data must be replaced by the next historical upload
+    client.post('/api/v1/insert_data')
+    reloaded = client.post('/api/v1/upload_historical_data')
+    assert "Data uploaded to Employee table successfully! - 200" in reloaded.data.decode()
+    assert "Data uploaded to Employee table successfully! - 200" in client.post('/api/v1/upload_historical_data?force=true').data.decode()
+
+def test_insert_data_writes_only_new_and_changed_rows(client, tmp_path, monkeypatch):
+
+    client.post('/api/v1/upload_historical_data')
+    (tmp_path / "data" / "New").mkdir(parents=True)
+    employees = tmp_path / "data" / "New" / "hired_employees.csv"
+    employees.write_text("9001,Ana,2021-01-01T00:00:00Z,1,1\n9002,Luis,2021-02-01T00:00:00Z,2,2\n")
+    monkeypatch.chdir(tmp_path)
+
+    assert "New records inserted in Employee table!" in client.post('/api/v1/insert_data').data.decode()
+    versions = {employee_id: employee_version(employee_id) for employee_id in (9001, 9002)}
+    summary = hire_summary_rows()
+    dataVersion = client.get('/api/v1/cache').json["data_version"]
+
+    #The same file is skipped, and a forced replay doesn't write any row
+    assert "New Employee CSV didn't change since it was inserted" in client.post('/api/v1/insert_data').data.decode()
+    assert client.get('/api/v1/cache').json["data_version"] == dataVersion
+    client.post('/api/v1/insert_data?force=true')
+    assert {employee_id: employee_version(employee_id) for employee_id in (9001, 9002)} == versions
+    assert hire_summary_rows() == summary
+
+    #Only the modified and the new rows of a changed file are written
+    employees.write_text("9001,Ana,2021-01-01T00:00:00Z,1,1\n9002,Luis,2022-02-01T00:00:00Z,2,2\n9003,Eva,2021-03-01T00:00:00Z,3,3\n")
+    os.utime(employees, (time.time() + 5, time.time() + 5))
+    client.post('/api/v1/insert_data')
+    assert employee_version(9001) == versions[9001]
+    assert employee_version(9002) != versions[9002]
+    with api.app_context():
+        assert db.session.get(EmployeeSchema, 9002).hired_at.year == 2022
+        assert db.session.get(EmployeeSchema, 9003).name == "Eva"